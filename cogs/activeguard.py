@@ -28,13 +28,12 @@ class ReportView(discord.ui.View):
                                                        {"$set": {"report_status": "accetped", "handled_by": interaction.user.id}})
 
         if report["report_status"] is not None or interaction.user.id == bot.config.owner_id:
-            doc = await bot.database.scammer_list.find_one({"user": report["reported_user"]})
-            if doc is None:
-                await bot.database.scammer_list.insert_one({
-                    "user": report["reported_user"],
-                    "time": time.time(),
-                    "reason": report["reason"]
-                })
+            await bot.database.scammer_list.update_one({"user": report["reported_user"]},
+                                                       {"$setOnInsert": {"time": time.time(),
+                                                                         "reason": report["reason"]}},
+                                                       upsert=True)
+            bot.blacklist.add(report["reported_user"])
+            bot.notify_clusters('blacklist_add', report["reported_user"])
 
         try:
             await bot.get_user(report["reporter"]).send(f"Your report on **{report['reported_user_name']}** has been accepted.")
@@ -71,9 +70,9 @@ class ReportView(discord.ui.View):
             await bot.database.reports.update_one({"report_id": report_id},
                                                        {"$set": {"report_status": "denied"}})
 
-        doc = await bot.database.scammer_list.find_one({"user": report["reported_user"]})
-        if doc is not None:
-            await bot.database.scammer_list.delete_one(doc)
+        await bot.database.scammer_list.delete_one({"user": report["reported_user"]})
+        bot.blacklist.remove(report["reported_user"])
+        bot.notify_clusters('blacklist_remove', report["reported_user"])
 
         try:
             await bot.get_user(report["reporter"]).send(f"Your report on **{report['reported_user_name']}** has been denied.")
@@ -98,41 +97,39 @@ class ActiveGuard(commands.Cog):
     async def on_message(self, message: discord.Message):
         if message.channel.type is discord.ChannelType.private:
             return
-        member = await message.guild.fetch_member(message.author.id)
-        doc = await self.bot.database.activeguardsettings.find_one({"guild": member.guild.id})
-        if doc is not None and doc.get('block_known_spammers') is True:
-            doc = await self.bot.database.scammer_list.find_one({"user": member.id})
-            if doc is not None:
-                await member.send(f'You have been banned from {member.guild.name} for being on the global blacklist. You can appeal this in our support server. https://discord.com/invite/TsuZCbz5KD')
-                await member.ban(reason="User is on global blacklist.")
-                self.bot.log(message.guild, 'Automod', 'Remove blacklisted user', 'User is on gobal blacklist. Blocking blacklisted users is enabled.', user=member)
+        settings = await self.bot.settings.activeguard.get(message.guild.id)
+        if settings is None or not settings.block_known_spammers:
+            return
+        if message.author.id not in self.bot.blacklist:
+            return
+        # Guild messages from the gateway already carry the member, only go to the API if it isn't cached.
+        member = message.author if isinstance(message.author, discord.Member) else message.guild.get_member(message.author.id)
+        if member is None:
+            self.bot.rest_calls['ActiveGuard.on_message'] += 1
+            member = await message.guild.fetch_member(message.author.id)
+        await member.send(f'You have been banned from {member.guild.name} for being on the global blacklist. You can appeal this in our support server. https://discord.com/invite/TsuZCbz5KD')
+        await member.ban(reason="User is on global blacklist.")
+        await self.bot.log(message.guild, 'Automod', 'Remove blacklisted user', 'User is on gobal blacklist. Blocking blacklisted users is enabled.', user=member)
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
-        doc = await self.bot.database.activeguardsettings.find_one({"guild": member.guild.id})
-        if doc is not None and doc.get('block_known_spammers') is True:
-            doc = await self.bot.database.scammer_list.find_one({"user": member.id})
-            if doc is not None:
+        settings = await self.bot.settings.activeguard.get(member.guild.id)
+        if settings is not None and settings.block_known_spammers:
+            if member.id in self.bot.blacklist:
                 await member.send(f'You have been banned from {member.guild.name} for being on the global blacklist. You can appeal this in our support server. https://discord.com/invite/TsuZCbz5KD')
                 await member.ban(reason="User is on global blacklist.")
-                self.bot.log(member.guild, 'Automod', 'Remove blacklisted user', 'User is on gobal blacklist. Blocking blacklisted users is enabled.', user=member)
+                await self.bot.log(member.guild, 'Automod', 'Remove blacklisted user', 'User is on gobal blacklist. Blocking blacklisted users is enabled.', user=member)
 
     active_guard = app_commands.Group(name='activeguard', description='Manage ActiveGuard settings',
                                       default_permissions=discord.Permissions(manage_guild=True))
 
     @active_guard.command(name='block_spammers', description='Should ActiveGuard block known spammers?')
     async def block_known_spammers(self, interaction: discord.Interaction, state: Literal['on', 'off']):
-        # Check if the guild has a document in the database, if not create one
-        if await self.bot.database.activeguardsettings.find_one({"guild_id": interaction.guild.id}) is None:
-            await self.bot.database.activeguardsettings.insert_one({"guild_id": interaction.guild.id})
-
         if state == 'on':
-            await self.bot.database.activeguardsettings.update_one({"guild_id": interaction.guild.id},
-                                                      {"$set": {"block_known_spammers": True}})
+            await self.bot.settings.activeguard.update(interaction.guild.id, {"block_known_spammers": True})
             await interaction.response.send_message('ActiveGuard will now block known spammers.', ephemeral=True)
         else:
-            await self.bot.database.activeguardsettings.update_one({"guild_id": interaction.guild.id},
-                                                      {"$set": {"block_known_spammers": False}})
+            await self.bot.settings.activeguard.update(interaction.guild.id, {"block_known_spammers": False})
             await interaction.response.send_message('ActiveGuard will no longer block known spammers.', ephemeral=True)
 
     @app_commands.command(name='report', description='report scammers')
@@ -143,8 +140,7 @@ class ActiveGuard(commands.Cog):
         if message is not None and message.author != user:
             interaction.response.send_message('The provided message isn\'t from the user whom you are trying to report!', ephemeral=True)
             return
-        doc = await self.bot.database.scammer_list.find_one({"user": user.id})
-        if doc is not None:
+        if user.id in self.bot.blacklist:
             await interaction.response.send_message('User already blacklisted.', ephemeral=True)
             return
         embed = discord.Embed(title=f'{interaction.user} has submitted a report!', color=discord.Color.red())
@@ -6,14 +6,23 @@ import discord
 from discord.ext import commands
 from discord import  app_commands
 import logging
-import aiohttp
 from typing import Literal
+from utils.perspective import ScoreCache, PerspectiveClient, PerspectiveError, PERSPECTIVE_URL, first_violation
+from utils.automod_rules import RuleEngine, BLOCK, MAX_PATTERNS, normalize_word, validate_pattern
 
 class Automod(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        
+        self.scores = ScoreCache()
+        self.rules = RuleEngine()
+        self.perspective = PerspectiveClient(bot, url=bot.config.perspective_url)
+
+    async def cog_load(self):
+        self.perspective.start()
+
+    async def cog_unload(self):
+        self.perspective.close()
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -22,29 +31,42 @@ class Automod(commands.Cog):
 
     @commands.Cog.listener()
     async def on_message(self, message):
-        try:    
-            doc = await self.bot.database.ai_detection.find_one({'guild': message.guild.id})
-            if doc is None or doc.get('enabled') is False:
-                return
-            if message.author.bot:
-                return
-        except AttributeError: return
-
-        headers = {"Content-Type": "application/json"}
-        data = '{comment: {text: "' + message.content + '"}, languages: ["en"], requestedAttributes: {TOXICITY:{}, SEVERE_TOXICITY: {}, IDENTITY_ATTACK: {}, INSULT: {}, PROFANITY: {}, THREAT: {}, FLIRTATION: {}, OBSCENE: {}, SPAM: {}} }'
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze?key={self.bot.config.perspective_api_key}", headers=headers, data=data) as resp:
-                resp_json = await resp.json()
-                for key, value in resp_json['attributeScores'].items():
-                    logging.debug(f"{key}: {int(float(value['summaryScore']['value'])*100)}%")
-                    if doc is not None and doc.get(key) is not None:
-                        if int(float(value['summaryScore']['value'])*100) >= doc.get(key):
-                            await message.delete()
-                            await message.author.send(f'Your message ```{message.content}``` was deleted because it was detected that `{key} >= {doc.get(key)}`')
-                            await self.bot.log(message.guild, 'Automod', 'AI Detection', f'{key} >= {doc.get(key)}', user=message.guild.me, target=message.author, message=message)
-                            return
+        if message.guild is None or message.author.bot:
+            return
+        result = self.rules.check(await self.bot.settings.automod.get(message.guild.id), message.content)
+        if result is not None:
+            verdict, rule = result
+            if verdict == BLOCK:
+                await self.remove(message, 'Rule Filter', rule)
+            return
+
+        # Without a key there is nothing to ask, unless perspective_url points at a local stand-in.
+        if not self.bot.config.perspective_api_key and self.perspective.url == PERSPECTIVE_URL:
+            return
+        settings = await self.bot.settings.ai_detection.get(message.guild.id)
+        if settings is None or not settings.enabled:
+            return
+
+        try:
+            scores = await self.scores.get_or_fetch(message.content, lambda: self.perspective.score(message.content))
+        except PerspectiveError as e:
+            # Fail open, nothing is removed while the API is unavailable.
+            logging.debug(f'Skipping AI detection: {e}')
+            return
+        for key, score in scores.items():
+            logging.debug(f"{key}: {score}%")
+        violation = first_violation(scores, settings.thresholds)
+        if violation is not None:
+            key, threshold = violation
+            await self.remove(message, 'AI Detection', f'{key} >= {threshold}')
 
+    async def remove(self, message: discord.Message, action: str, reason: str):
+        await message.delete()
+        await message.author.send(f'Your message ```{message.content}``` was deleted because it was detected that `{reason}`')
+        await self.bot.log(message.guild, 'Automod', action, reason, user=message.guild.me, target=message.author, message=message)
+
+    def perf_stats(self) -> list[str]:
+        return ['**Automod**', self.perspective.stats(), self.scores.stats()] + self.rules.stats()
         
     
     auto_mod = app_commands.Group(name='automod', description='Manage Automod settings',
@@ -53,11 +75,11 @@ class Automod(commands.Cog):
     @auto_mod.command(name='ai', description='Manage AI automod settings. Recommended to set to 70-80% for best results.')
     async def automod(self, interaction: discord.Interaction, enabled: bool=None, option: Literal['TOXICITY', 'SEVERE_TOXICITY', 'IDENTITY_ATTACK', 'INSULT', 'PROFANITY', 'THREAT', 'FLIRTATION', 'OBSCENE', 'SPAM']=None, value: int=None):
         if enabled is False:
-            await self.bot.database.ai_detection.update_one({'guild': interaction.guild.id}, {'$set': {'enabled': False}})
+            await self.bot.settings.ai_detection.update(interaction.guild.id, {'enabled': False})
             await interaction.response.send_message(f'AI Detection disabled.', ephemeral=True)
             return
         elif enabled is True:
-            await self.bot.database.ai_detection.update_one({'guild': interaction.guild.id}, {'$set': {'enabled': True}})
+            await self.bot.settings.ai_detection.update(interaction.guild.id, {'enabled': True})
             await interaction.response.send_message(f'AI Detection enabled.', ephemeral=True)
             return
             
@@ -74,19 +96,46 @@ class Automod(commands.Cog):
             await interaction.response.send_message(f'Invalid arguments. Please provide an enabled state, or an option and value.', ephemeral=True)
             return
 
-        if await self.bot.database.ai_detection.find_one({'guild': interaction.guild.id}) is not None:
-            await self.bot.database.ai_detection.update_one({'guild': interaction.guild.id}, {'$set': {option: value}})
-        else:
-            await self.bot.database.ai_detection.insert_one({'guild': interaction.guild.id, option: value})
-        
+        await self.bot.settings.ai_detection.update(interaction.guild.id, {option: value})
+
         await interaction.response.send_message(f'`{option}` set to `{value}`', ephemeral=True)
 
+    @auto_mod.command(name='words', description='Manage words that are always removed')
+    async def automod_words(self, interaction: discord.Interaction, action: Literal['add', 'remove'], word: str):
+        word = normalize_word(word)
+        if not word:
+            await interaction.response.send_message('Please provide a word.', ephemeral=True)
+            return
+        update = {'$addToSet': {'blocked_words': word}} if action == 'add' else {'$pull': {'blocked_words': word}}
+        await self.bot.settings.automod.modify(interaction.guild.id, update)
+
+        await interaction.response.send_message(f'`{word}` {"added to" if action == "add" else "removed from"} the word filter.', ephemeral=True)
+
+    @auto_mod.command(name='regex', description='Manage regular expressions that are always removed')
+    async def automod_regex(self, interaction: discord.Interaction, action: Literal['add', 'remove'], pattern: str):
+        if action == 'add':
+            error = validate_pattern(pattern)
+            if error is None:
+                doc = await self.bot.settings.automod.collection.find_one({'guild': interaction.guild.id}, {'blocked_patterns': 1})
+                if doc is not None and len(doc.get('blocked_patterns', [])) >= MAX_PATTERNS:
+                    error = f'A server can have at most {MAX_PATTERNS} patterns.'
+            if error is not None:
+                await interaction.response.send_message(error, ephemeral=True)
+                return
+        update = {'$addToSet': {'blocked_patterns': pattern}} if action == 'add' else {'$pull': {'blocked_patterns': pattern}}
+        await self.bot.settings.automod.modify(interaction.guild.id, update)
+
+        await interaction.response.send_message(f'`{pattern}` {"added to" if action == "add" else "removed from"} the regex filter.', ephemeral=True)
+
+    @auto_mod.command(name='min_length', description='Messages shorter than this are never sent to AI detection')
+    async def automod_min_length(self, interaction: discord.Interaction, value: app_commands.Range[int, 0, 100]):
+        await self.bot.settings.automod.update(interaction.guild.id, {'min_length': value})
+
+        await interaction.response.send_message(f'Minimum length set to `{value}`', ephemeral=True)
+
     @auto_mod.command(name='log', description='Set the log channel for automod')
     async def automod_log(self, interaction: discord.Interaction, channel: discord.TextChannel):
-        if await self.bot.database.automodsettings.find_one({'guild': interaction.guild.id}) is not None:
-            await self.bot.database.automodsettings.update_one({'guild': interaction.guild.id}, {'$set': {'log_channel': channel.id}})
-        else:
-            await self.bot.database.automodsettings.insert_one({'guild': interaction.guild.id, 'log_channel': channel.id})
+        await self.bot.settings.automod.update(interaction.guild.id, {'log_channel': channel.id})
 
         await interaction.response.send_message(f'Log channel set to {channel.mention}', ephemeral=True)
 
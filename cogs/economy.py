@@ -8,46 +8,130 @@ from discord.ext import commands
 from discord import app_commands
 import random
 import logging
+from typing import Literal
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+from utils.ledger import currency_update
+
+# Returned by servers that aren't part of a replica set when a transaction is started.
+ILLEGAL_OPERATION = 20
 
 """ currency data format:
 {
     "userID": "",
-    "wallet": "",
-    "bank": "",
+    "wallet": 0,
+    "bank": 0,
+    "total": 0,
     "inventory": []
 }
+wallet and bank used to be stored as strings, run utils/migrate_currency.py to convert old documents.
 """
 
 
 class UserProfile:
+    """A user's currency document, read at most once.
+
+    wallet/bank/inventory are served from the first read. Writes made through the profile drop the snapshot, so the
+    next read sees the new balance.
+    """
+
     def __init__(self, bot, database, user: discord.User):
         self.bot = bot
         self.database = database
         self.user = user
+        self._doc = None
 
     async def async_init(self):
-        await self.bot.addcurrency(self.user, 0, 'wallet')
+        await self.doc()
+
+    async def doc(self) -> dict:
+        if self._doc is None:
+            doc = await self.database.currency.find_one({'userID': str(self.user.id)})
+            # Users without a document haven't earned anything yet, the first write creates it.
+            self._doc = doc if doc is not None else {'userID': str(self.user.id), 'wallet': 0, 'bank': 0,
+                                                     'inventory': []}
+            if self.bot.ledger is not None:
+                for location, value in self.bot.ledger.pending(str(self.user.id)).items():
+                    self._doc[location] = int(self._doc.get(location, 0)) + value
+        return self._doc
+
+    def invalidate(self):
+        self._doc = None
+
+    async def flush_pending(self):
+        # Conditional updates compare against the stored balance, so buffered payouts have to land first.
+        if self.bot.ledger is not None:
+            await self.bot.ledger.flush_user(str(self.user.id))
 
     async def wallet(self) -> int:
-        doc = await self.database.currency.find_one({'userID': str(self.user.id)})
-        return int(doc['wallet'])
+        return int((await self.doc()).get('wallet', 0))
 
     async def bank(self) -> int:
-        doc = await self.database.currency.find_one({'userID': str(self.user.id)})
-        return int(doc['bank'])
+        return int((await self.doc()).get('bank', 0))
 
     async def inventory(self) -> list:
-        doc = await self.database.currency.find_one({'userID': str(self.user.id)})
-        return list(doc['inventory'])
-
-    async def doc(self):
-        return await self.database.currency.find_one({'userID': str(self.user.id)})
+        return list((await self.doc()).get('inventory', []))
 
     async def addcurrency(self, amount: int, location: str):
         location = location.lower()
         if location not in ['wallet', 'bank']:
             raise ValueError(f"Parameter \"location\" must be 'wallet' or 'bank' got: {location}")
         await self.bot.addcurrency(self.user, amount, location)
+        self.invalidate()
+
+    async def transfer(self, amount: int, source: str, destination: str) -> bool:
+        """Move beans between this user's wallet and bank in one update.
+        Returns False without changing anything if the source holds less than amount."""
+        if {source, destination} != {'wallet', 'bank'}:
+            raise ValueError(f"Can only transfer between 'wallet' and 'bank' got: {source}, {destination}")
+        await self.flush_pending()
+        result = await self.database.currency.update_one({'userID': str(self.user.id), source: {'$gte': amount}},
+                                                         {'$inc': {source: -amount, destination: amount}})
+        self.invalidate()
+        return result.matched_count == 1
+
+    async def transfer_to(self, target: 'UserProfile', amount: int, location: str = 'wallet', require: int = 0) -> bool:
+        """Move beans from this user's location to the target's, in one transaction.
+        Returns False if this user holds less than amount, or less than require if that is higher."""
+        if location not in ['wallet', 'bank']:
+            raise ValueError(f"Parameter \"location\" must be 'wallet' or 'bank' got: {location}")
+        await self.flush_pending()
+        debit = ({'userID': str(self.user.id), location: {'$gte': max(amount, require)}},
+                 {'$inc': {location: -amount, 'total': -amount}})
+        credit = ({'userID': str(target.user.id)}, currency_update({location: amount}))
+        async def move(session) -> tuple[dict | None, dict | None]:
+            # Called again from the start when the transaction hits a transient error.
+            doc = await self.database.currency.find_one_and_update(
+                *debit, projection={'total': 1}, return_document=ReturnDocument.AFTER, session=session)
+            if doc is None:
+                return None, None
+            return doc, await self.database.currency.find_one_and_update(
+                *credit, projection={'total': 1}, upsert=True, return_document=ReturnDocument.AFTER, session=session)
+
+        try:
+            async with await self.database.client.start_session() as session:
+                doc, target_doc = await session.with_transaction(move)
+        except OperationFailure as e:
+            # Standalone servers don't support transactions, refund the debit by hand if the credit fails instead.
+            if e.code != ILLEGAL_OPERATION:
+                raise
+            doc = await self.database.currency.find_one_and_update(
+                *debit, projection={'total': 1}, return_document=ReturnDocument.AFTER)
+            if doc is not None:
+                try:
+                    target_doc = await self.database.currency.find_one_and_update(
+                        *credit, projection={'total': 1}, upsert=True, return_document=ReturnDocument.AFTER)
+                except Exception:
+                    await self.database.currency.update_one({'userID': str(self.user.id)},
+                                                            {'$inc': {location: amount, 'total': amount}})
+                    raise
+        self.invalidate()
+        target.invalidate()
+        if doc is None:
+            return False
+        self.bot.leaderboard.record(self.user, doc['total'])
+        self.bot.leaderboard.record(target.user, target_doc['total'])
+        return True
 
 
 class Economy(commands.Cog):
@@ -62,7 +146,10 @@ class Economy(commands.Cog):
     @commands.command()
     @commands.is_owner()
     async def resetuser(self, ctx, user: discord.User):
+        if self.bot.ledger is not None:
+            self.bot.ledger.discard(str(user.id))
         await self.bot.database.currency.delete_one({'userID': str(user.id)})
+        self.bot.leaderboard.remove(str(user.id))
         await ctx.send('User removed successfully!')
 
     @commands.command()
@@ -74,7 +161,7 @@ class Economy(commands.Cog):
     @app_commands.checks.cooldown(1, 6, key=lambda i: i.user.id)
     async def beg(self, interaction: discord.Interaction):
         amount = random.randint(0, 100)
-        await self.bot.addcurrency(interaction.user, amount, 'wallet')
+        await self.bot.addcurrency(interaction.user, amount, 'wallet', buffered=True)
         await interaction.response.send_message(f'You gained {amount} from begging!')
 
     @app_commands.command(name="balance", description='View your bean count')
@@ -82,28 +169,49 @@ class Economy(commands.Cog):
         if not user:
             user = interaction.user
         profile = UserProfile(self.bot, self.bot.database, user)
-        await profile.async_init()
         await interaction.response.send_message(
             f"*{user.name}'s* balance:\n**Wallet: **{await profile.wallet()} beans\n**Bank: **{await profile.bank()} beans")
 
+    @app_commands.command(name="leaderboard", description='See who has the most beans')
+    async def leaderboard(self, interaction: discord.Interaction, scope: Literal['global', 'server'] = 'global',
+                          page: int = 1):
+        page_size = 10
+        if page < 1 or page * page_size > self.bot.leaderboard.size:
+            await interaction.response.send_message(
+                f'Page must be between 1 and {self.bot.leaderboard.size // page_size}', ephemeral=True)
+            return
+        if scope == 'server' and interaction.guild is not None:
+            board = await self.bot.leaderboard.guild_board(interaction.guild)
+            title = f'{interaction.guild.name} leaderboard'
+        else:
+            board = self.bot.leaderboard.board
+            title = 'Global leaderboard'
+        start = (page - 1) * page_size
+        lines = [f'**{rank}.** <@{user_id}> - {total} beans'
+                 for rank, (user_id, total) in enumerate(board.page(start, page_size), start=start + 1)]
+        embed = discord.Embed(title=title, description='\n'.join(lines) if lines else 'Nobody has any beans yet!',
+                              color=discord.Color.gold())
+        embed.set_footer(text=f'Page {page}')
+        await interaction.response.send_message(embed=embed)
+
     @app_commands.command(name="deposit", description='Deposit beans')
     async def deposit(self, interaction: discord.Interaction, amount: str):
         profile = UserProfile(self.bot, self.bot.database, interaction.user)
-        await profile.async_init()
         try:
-            int(amount)
-        except:
+            amount = int(amount)
+        except ValueError:
             if amount.lower() == 'all':
-                amount = int(await profile.wallet())
+                amount = await profile.wallet()
             elif amount.lower() == 'half':
-                amount = int(await profile.wallet()) // 2
+                amount = await profile.wallet() // 2
             else:
                 await interaction.response.send_message('Value must be a number, "all", or "half"', ephemeral=True)
                 return
-        if int(amount) <= int(await profile.wallet()):
-            await profile.addcurrency(-int(amount), 'wallet')
-            await profile.addcurrency(int(amount), 'bank')
-            await interaction.response.send_message(f'Deposited {int(amount)} beans')
+        if amount < 0:
+            await interaction.response.send_message('You can\'t deposit a negative amount!', ephemeral=True)
+            return
+        if await profile.transfer(amount, 'wallet', 'bank'):
+            await interaction.response.send_message(f'Deposited {amount} beans')
         else:
             await interaction.response.send_message('You are trying to deposit more beans than you have!',
                                                     ephemeral=True)
@@ -111,20 +219,20 @@ class Economy(commands.Cog):
     @app_commands.command(name="withdraw", description="Withdraw beans")
     async def withdraw(self, interaction: discord.Interaction, amount: str):
         profile = UserProfile(self.bot, self.bot.database, interaction.user)
-        await profile.async_init()
         try:
-            int(amount)
-        except:
+            amount = int(amount)
+        except ValueError:
             if amount.lower() == 'all':
-                amount = int(await profile.bank())
+                amount = await profile.bank()
             elif amount.lower() == 'half':
-                amount = int(await profile.bank()) // 2
+                amount = await profile.bank() // 2
             else:
                 await interaction.response.send_message('Value must be a number, "all", or "half"', ephemeral=True)
                 return
-        if int(amount) <= int(await profile.bank()):
-            await profile.addcurrency(int(amount), 'wallet')
-            await profile.addcurrency(-int(amount), 'bank')
+        if amount < 0:
+            await interaction.response.send_message('You can\'t withdraw a negative amount!', ephemeral=True)
+            return
+        if await profile.transfer(amount, 'bank', 'wallet'):
             await interaction.response.send_message(f'Withdrew {amount} beans')
         else:
             await interaction.response.send_message('You are trying to withdraw more beans than you have!',
@@ -135,24 +243,26 @@ class Economy(commands.Cog):
     @app_commands.checks.cooldown(1, 30, key=lambda i: i.user.id)
     async def rob(self, interaction: discord.Interaction, user: discord.User):
         profile = UserProfile(self.bot, self.bot.database, interaction.user)
-        await profile.async_init()
         target_profile = UserProfile(self.bot, self.bot.database, user)
-        await target_profile.async_init()
-        if int(await target_profile.wallet()) <= 11:
+        target_wallet = await target_profile.wallet()
+        if target_wallet <= 11:
             await interaction.response.send_message('They have no beans!', ephemeral=True)
-        else:
-            if int(await profile.wallet()) <= 50:
-                await interaction.response.send_message('You don\'t have enough money in your wallet!', ephemeral=True)
-                return
-            amount = random.randint(0, int(await profile.wallet() // 6))
-            if amount < 2:
-                await interaction.response.send_message('You were caught! You pay 50 beans in fines.')
-                await profile.addcurrency(-50, 'wallet')
-                return
-            await target_profile.addcurrency(-amount, 'wallet')
-            await profile.addcurrency(amount, 'wallet')
-            await interaction.response.send_message(f"Stole {amount} beans from {user.mention}")
-
+            return
+        wallet = await profile.wallet()
+        if wallet <= 50:
+            await interaction.response.send_message('You don\'t have enough money in your wallet!', ephemeral=True)
+            return
+        amount = random.randint(0, wallet // 6)
+        if amount < 2:
+            await interaction.response.send_message('You were caught! You pay 50 beans in fines.')
+            await profile.addcurrency(-50, 'wallet')
+            return
+        amount = min(amount, target_wallet)
+        # The wallet read above may be stale, the transfer checks both conditions again in the same update.
+        if not await target_profile.transfer_to(profile, amount, 'wallet', require=12):
+            await interaction.response.send_message('They have no beans!', ephemeral=True)
+            return
+        await interaction.response.send_message(f"Stole {amount} beans from {user.mention}")
 
 
 async def setup(bot):
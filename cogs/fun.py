@@ -6,13 +6,34 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import random
-import aiohttp
 import logging
 import asyncio
-import pilcord
-from bill import insult
-import wikipedia
-from faker import Faker
+import os
+import functools
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from utils.lazy_import import LazyModule
+from utils.prefetch import PrefetchPool
+from utils.response_cache import ResponseCache, normalize
+from utils.lexicon import Lexicon
+from utils.fake_identities import FakerPool
+from utils.meme_renderer import MemeRenderer, InvalidImage
+
+# These are slow to import and only needed by a few commands.
+bill = LazyModule('bill')
+wikipedia = LazyModule('wikipedia')
+
+
+# name: (url, headers, response field)
+RANDOM_SOURCES = {
+    'yomama': ('https://api.yomomma.info/', {}, 'joke'),
+    'dadjoke': ('https://icanhazdadjoke.com/', {"Accept": "application/json"}, 'joke'),
+    'dog': ('https://dog.ceo/api/breeds/image/random', {}, 'message'),
+    'duck': ('https://random-d.uk/api/random', {}, 'url'),
+    'cat': ('https://aws.random.cat/meow', {}, 'file'),
+    'meme': ('https://meme-api.com/gimme', {}, 'url'),
+    'joke': ('https://v2.jokeapi.dev/joke/Any?blacklistFlags=nsfw,racist,sexist,explicit&type=single', {}, 'joke'),
+}
 
 
 class Fun(commands.Cog):
@@ -24,6 +45,46 @@ class Fun(commands.Cog):
             ['W', 'D', 'L'],
             ['L', 'W', 'D'],
         ]
+        self.prefetch = {name: PrefetchPool(name, self.random_fetcher(*source)) for name, source in RANDOM_SOURCES.items()}
+        self.prefetch_tasks = []
+        # Bounded so a slow API can't tie up the default executor other code relies on.
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='fun')
+        self.lexicon = Lexicon.open(bot.config.lexicon_path)
+        self.fakes = FakerPool()
+        self.renderer = MemeRenderer()
+        cache_dir = bot.config.response_cache_dir
+        self.caches = {name: ResponseCache(name, path=os.path.join(cache_dir, f'{name}.json') if cache_dir else None)
+                       for name in ['rel_syn', 'rel_ant', 'wikipedia']}
+
+    def random_fetcher(self, url: str, headers: dict, field: str):
+        async def fetch():
+            async with self.bot.session.get(url, headers=headers) as r:
+                res = await r.json()
+                return res[field]
+        return fetch
+
+    async def cog_load(self):
+        async def start(pool):
+            # bot.session is created in setup_hook, which runs after cogs are loaded.
+            await self.bot.wait_until_ready()
+            await pool.run()
+        self.prefetch_tasks = [asyncio.create_task(start(pool)) for pool in self.prefetch.values()]
+
+    async def cog_unload(self):
+        for task in self.prefetch_tasks:
+            task.cancel()
+        for cache in self.caches.values():
+            cache.save()
+        self.executor.shutdown(wait=False)
+        self.renderer.close()
+        self.fakes.close()
+        if self.lexicon is not None:
+            self.lexicon.close()
+
+    def perf_stats(self) -> list[str]:
+        return (['**Prefetch pools**'] + [pool.stats() for pool in self.prefetch.values()] +
+                ['**Response caches**'] + [cache.stats() for cache in self.caches.values()] +
+                ([self.lexicon.stats()] if self.lexicon is not None else []) + [self.fakes.stats(), self.renderer.stats()])
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -33,52 +94,31 @@ class Fun(commands.Cog):
 
     @app_commands.command(name="yomama", description="get a yo mama joke")
     async def yomama(self, interaction: discord.Interaction):
-        async with aiohttp.ClientSession() as cs:
-            async with cs.get('https://api.yomomma.info/') as r:
-                res = await r.json()  # returns dict
-                await interaction.response.send_message(res["joke"])
+        await interaction.response.send_message(await self.prefetch['yomama'].get())
 
     @app_commands.command(name="dadjoke", description="get dad joked")
     async def dadjoke(self, interaction: discord.Interaction):
-        async with aiohttp.ClientSession() as cs:
-            async with cs.get('https://icanhazdadjoke.com/', headers={"Accept": "application/json"}) as r:
-                res = await r.json()
-                await interaction.response.send_message(res["joke"])
+        await interaction.response.send_message(await self.prefetch['dadjoke'].get())
 
     @app_commands.command(name="dog", description="dog pic")
     async def dog(self, interaction: discord.Interaction):
-        async with aiohttp.ClientSession() as cs:
-            async with cs.get('https://dog.ceo/api/breeds/image/random') as r:
-                res = await r.json()
-                await interaction.response.send_message(res["message"])
+        await interaction.response.send_message(await self.prefetch['dog'].get())
 
     @app_commands.command(name="duck", description="get a duck pic")
     async def duck(self, interaction: discord.Interaction):
-        async with aiohttp.ClientSession() as cs:
-            async with cs.get('https://random-d.uk/api/random') as r:
-                res = await r.json()
-                await interaction.response.send_message(res["url"])
+        await interaction.response.send_message(await self.prefetch['duck'].get())
 
     @app_commands.command(name="cat", description='cat pic')
     async def cat(self, interaction: discord.Interaction):
-        async with aiohttp.ClientSession() as cs:
-            async with cs.get('https://aws.random.cat/meow') as r:
-                res = await r.json()
-                await interaction.response.send_message(res["file"])
+        await interaction.response.send_message(await self.prefetch['cat'].get())
 
     @app_commands.command(name="meme", description="🤣")
     async def meme(self, interaction: discord.Interaction):
-        async with aiohttp.ClientSession() as cs:
-            async with cs.get('https://meme-api.com/gimme') as r:
-                res = await r.json()
-                await interaction.response.send_message(res["url"])
+        await interaction.response.send_message(await self.prefetch['meme'].get())
 
     @app_commands.command(name="joke", description="its just a joke??")
     async def joke(self, interaction: discord.Interaction):
-        async with aiohttp.ClientSession() as cs:
-            async with cs.get('https://v2.jokeapi.dev/joke/Any?blacklistFlags=nsfw,racist,sexist,explicit&type=single') as r:
-                res = await r.json()
-                await interaction.response.send_message(res['joke'])
+        await interaction.response.send_message(await self.prefetch['joke'].get())
 
     @app_commands.command(name='8ball', description='get advice on anything')
     async def _8ball(self, interaction: discord.Interaction, question: str):
@@ -113,19 +153,18 @@ class Fun(commands.Cog):
 
         if outcome == 'W':
             await message.reply('You win! +50 beans')
-            await self.bot.addcurrency(message.author, 50, 'wallet')
+            await self.bot.addcurrency(message.author, 50, 'wallet', buffered=True)
         elif outcome == 'L':
             await message.reply('I win!')
         elif outcome == 'D':
             await message.reply('Draw!')
     
-    @app_commands.command(name='fight_under_this_flag', description='fight under this flag meme')
-    @app_commands.checks.cooldown(1, 5, key=lambda i: i.user.id)
-    async def fight_under_this_flag(self, interaction: discord.Interaction, user: discord.Member = None, flag: discord.Attachment = None, flag_url: str = None):
+    async def send_meme(self, interaction: discord.Interaction, template: str, user: discord.Member,
+                        flag: discord.Attachment, flag_url: str):
         if user is None and flag is None and flag_url is None:
-            image = interaction.user.avatar.url
+            image = interaction.user.display_avatar.url
         elif user is not None and flag is None and flag_url is None:
-            image = user.avatar.url
+            image = user.display_avatar.url
         elif user is None and flag is not None and flag_url is None:
             image = flag.url
         elif user is None and flag is None and flag_url is not None:
@@ -134,89 +173,82 @@ class Fun(commands.Cog):
             await interaction.response.send_message('Something went wrong, please try again', ephemeral=True)
             return
         await interaction.response.defer()
-        a = pilcord.Meme(avatar=image)
-        await interaction.followup.send(file=discord.File(await a.fight_under_this_flag(), filename='fight_under_this_flag.png'))
+        try:
+            png = await self.renderer.render(self.bot.session, template, image)
+        except InvalidImage:
+            await interaction.followup.send('I couldn\'t use that image, please try another one.', ephemeral=True)
+            return
+        await interaction.followup.send(file=discord.File(BytesIO(png), filename=f'{template}.png'))
+
+    @app_commands.command(name='fight_under_this_flag', description='fight under this flag meme')
+    @app_commands.checks.cooldown(1, 5, key=lambda i: i.user.id)
+    async def fight_under_this_flag(self, interaction: discord.Interaction, user: discord.Member = None, flag: discord.Attachment = None, flag_url: str = None):
+        await self.send_meme(interaction, 'fight_under_this_flag', user, flag, flag_url)
     
     @app_commands.command(name='uwu_discord', description='uwu discord meme')
     @app_commands.checks.cooldown(1, 5, key=lambda i: i.user.id)
     async def uwu_discord(self, interaction: discord.Interaction, user: discord.Member = None, flag: discord.Attachment = None, flag_url: str = None):
-        if user is None and flag is None and flag_url is None:
-            image = interaction.user.avatar.url
-        elif user is not None and flag is None and flag_url is None:
-            image = user.avatar.url
-        elif user is None and flag is not None and flag_url is None:
-            image = flag.url
-        elif user is None and flag is None and flag_url is not None:
-            image = flag_url
-        else:
-            await interaction.response.send_message('Something went wrong, please try again', ephemeral=True)
-            return
-        await interaction.response.defer()
-        a = pilcord.Meme(avatar=image)
-        await interaction.followup.send(file=discord.File(await a.uwu_discord(), filename='uwu_discord.png'))
+        await self.send_meme(interaction, 'uwu_discord', user, flag, flag_url)
     
     @app_commands.command(name='rip', description='rip meme')
     @app_commands.checks.cooldown(1, 5, key=lambda i: i.user.id)
     async def rip(self, interaction: discord.Interaction, user: discord.Member = None, flag: discord.Attachment = None, flag_url: str = None):
-        if user is None and flag is None and flag_url is None:
-            image = interaction.user.avatar.url
-        elif user is not None and flag is None and flag_url is None:
-            image = user.avatar.url
-        elif user is None and flag is not None and flag_url is None:
-            image = flag.url
-        elif user is None and flag is None and flag_url is not None:
-            image = flag_url
-        else:
-            await interaction.response.send_message('Something went wrong, please try again', ephemeral=True)
-            return
-        await interaction.response.defer()
-        a = pilcord.Meme(avatar=image)
-        await interaction.followup.send(file=discord.File(await a.rip(), filename='rip.png'))
+        await self.send_meme(interaction, 'rip', user, flag, flag_url)
     
+    async def related_words(self, relation: str, word: str) -> list[str]:
+        """Looks in the local lexicon first, Datamuse only for words it doesn't know."""
+        if self.lexicon is not None:
+            words = self.lexicon.lookup(normalize(word), relation)
+            if words is not None:
+                return words
+
+        async def fetch():
+            async with self.bot.session.get('https://api.datamuse.com/words', params={relation: normalize(word)}) as r:
+                res = await r.json()
+                return [i['word'] for i in res[:10]]
+        return await self.caches[relation].get_or_fetch(word, fetch)
+
     @app_commands.command(name='synonym', description='get a synonym')
     async def synonym(self, interaction: discord.Interaction, word: str):
-        async with aiohttp.ClientSession() as cs:
-            async with cs.get(f'https://api.datamuse.com/words?rel_syn={word}') as r:
-                res = await r.json()
-                words = []
-                for i in res:
-                    if len(words) < 10:
-                        words.append(i['word'])
-                    else: break
-                await interaction.response.send_message(f"Synonyms for {word}:\n{', '.join(words)}")
+        words = await self.related_words('rel_syn', word)
+        await interaction.response.send_message(f"Synonyms for {word}:\n{', '.join(words)}")
     
     @app_commands.command(name='antonym', description='get an antonym')
     async def antonym(self, interaction: discord.Interaction, word: str):
-        async with aiohttp.ClientSession() as cs:
-            async with cs.get(f'https://api.datamuse.com/words?rel_ant={word}') as r:
-                res = await r.json()
-                words = []
-                for i in res:
-                    if len(words) < 10:
-                        words.append(i['word'])
-                    else: break
-                await interaction.response.send_message(f"Antonyms for {word}:\n{', '.join(words)}")
+        words = await self.related_words('rel_ant', word)
+        await interaction.response.send_message(f"Antonyms for {word}:\n{', '.join(words)}")
     
     @app_commands.command(name='shakespearean-insult', description='get a shakespearean insult')
     async def shakespearean_insult(self, interaction: discord.Interaction):
-        await interaction.response.send_message(insult())
+        await interaction.response.send_message(bill.insult())
     
     @app_commands.command(name='wikipedia', description='get a wikipedia article')
     async def wikipedia(self, interaction: discord.Interaction, query: str):
+        summary = self.caches['wikipedia'].get(query)
+        if summary is not None:
+            await interaction.response.send_message(summary)
+            return
+        # The wikipedia package is synchronous, run it on the executor so it doesn't block the event loop.
+        await interaction.response.defer(thinking=True)
         try:
-            await interaction.response.send_message(wikipedia.summary(query, sentences=2))
+            summary = await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(wikipedia.summary, query, sentences=2)), timeout=10)
         except wikipedia.exceptions.DisambiguationError as e:
-            options = []
-            for i in e.options:
-                if len(options) < 10:
-                    options.append(i)
-                else: break
-            await interaction.response.send_message(f"Could not determine what you meant, please be more specific. Here are some options:\n{', '.join(options)}", ephemeral=True)
+            await interaction.followup.send(f"Could not determine what you meant, please be more specific. Here are some options:\n{', '.join(e.options[:10])}")
+            return
+        except wikipedia.exceptions.PageError:
+            await interaction.followup.send(f"Couldn't find a wikipedia article for `{query}`.")
+            return
+        except asyncio.TimeoutError:
+            await interaction.followup.send('Wikipedia took too long to respond, please try again later.')
+            return
+        self.caches['wikipedia'].set(query, summary)
+        await interaction.followup.send(summary)
 
     @app_commands.command(name="fake-info", description="get fake info")
     async def fake_info(self, interaction: discord.Interaction):
-        fake = Faker()
-        await interaction.response.send_message(f"{fake.name()}\n{fake.address()}")
+        name, address = await self.fakes.identity()
+        await interaction.response.send_message(f"{name}\n{address}")
 
 
 async def setup(bot):
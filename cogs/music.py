@@ -6,10 +6,12 @@ import time
 import discord
 from discord.ext import commands
 from discord import app_commands
-import youtube_dl
-import pafy
 import asyncio
 import logging
+from utils.lazy_import import LazyModule
+
+youtube_dl = LazyModule('youtube_dl')
+pafy = LazyModule('pafy')
 
 queue = {}
 
@@ -0,0 +1,78 @@
+# Starts the bot as several processes, each running a range of shards.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+"""
+Usage: python3 launcher.py [-c CLUSTERS] [-s SHARDS]
+Defaults to one cluster per CPU core and Discord's recommended shard count. Each cluster is a normal main.py process
+with sharding enabled, crashed clusters are restarted. Clusters answer global owner commands through utils/ipc.py.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import secrets
+import logging
+import argparse
+import requests
+from utils.ipc import IPCServer
+
+logging.basicConfig(format="[%(asctime)s] [%(levelname)8s] --- %(message)s (launcher)", datefmt='%H:%M:%S',
+                    level=logging.INFO)
+
+parser = argparse.ArgumentParser(prog='ClusterLauncher', description='Run kidney bot as multiple shard clusters.')
+parser.add_argument('-c', '--clusters', type=int, default=os.cpu_count())
+parser.add_argument('-s', '--shards', type=int, help='defaults to the shard count Discord recommends')
+parser.add_argument('--restart-delay', type=float, default=10)
+
+args = parser.parse_args()
+
+
+def recommended_shards(token: str) -> int:
+    resp = requests.get('https://discord.com/api/v10/gateway/bot', headers={'Authorization': f'Bot {token}'})
+    resp.raise_for_status()
+    return resp.json()['shards']
+
+
+def shard_ranges(shard_count: int, clusters: int) -> list[list[int]]:
+    clusters = max(1, min(clusters, shard_count))
+    per_cluster, extra = divmod(shard_count, clusters)
+    ranges, start = [], 0
+    for cluster in range(clusters):
+        size = per_cluster + (1 if cluster < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+async def run_cluster(cluster_id: int, shard_ids: list[int], shard_count: int, ipc: IPCServer):
+    env = dict(os.environ, KB_CLUSTER_ID=str(cluster_id), KB_SHARD_IDS=','.join(map(str, shard_ids)),
+               KB_SHARD_COUNT=str(shard_count), KB_IPC_PORT=str(ipc.port), KB_IPC_SECRET=ipc.secret)
+    while True:
+        logging.info(f'Starting cluster {cluster_id} with shards {shard_ids[0]}-{shard_ids[-1]}')
+        process = await asyncio.create_subprocess_exec(sys.executable, 'main.py', env=env)
+        code = await process.wait()
+        logging.error(f'Cluster {cluster_id} exited with code {code}, restarting in {args.restart_delay}s')
+        await asyncio.sleep(args.restart_delay)
+
+
+async def main():
+    with open('config.json', 'r') as f:
+        token = json.load(f)['token']
+    shard_count = args.shards or recommended_shards(token)
+    ranges = shard_ranges(shard_count, args.clusters)
+    logging.info(f'Running {shard_count} shards in {len(ranges)} clusters')
+
+    ipc = IPCServer(secrets.token_hex(32))
+    await ipc.start()
+
+    clusters = []
+    for cluster_id, shard_ids in enumerate(ranges):
+        clusters.append(asyncio.create_task(run_cluster(cluster_id, shard_ids, shard_count, ipc)))
+        # Discord only lets one shard identify every 5 seconds, so don't start them all at once.
+        await asyncio.sleep(5 * len(shard_ids))
+    await asyncio.gather(*clusters)
+
+
+asyncio.run(main())
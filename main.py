@@ -2,6 +2,9 @@
 # Copyright (C) 2023  Alec Jensen
 # Full license at LICENSE.md
 
+from utils.startup import StartupTimeline
+startup = StartupTimeline()
+
 import discord
 from discord.ext import commands
 import random
@@ -11,7 +14,26 @@ import logging
 import json
 import datetime
 import sys
+import time
+import hashlib
+import inspect
+import itertools
+from collections import Counter
+from pymongo import ReturnDocument
 import cogs.activeguard
+from utils.settings_cache import SettingsCache
+from utils.blacklist import ScammerBlacklist
+from utils.ledger import CurrencyLedger, currency_update
+from utils.leaderboard import Leaderboard
+from utils.indexes import ensure_indexes
+from utils.log_dispatcher import LogDispatcher
+from utils.broadcast import Broadcast, BroadcastRunning
+from utils.ipc import IPCClient
+from utils.http_session import RequestStats, create_session
+from utils.loop_monitor import LoopStallDetector
+from utils.perspective import PERSPECTIVE_URL
+
+startup.mark('imports')
 
 now = datetime.datetime.now()
 if not os.path.exists('logs'):
@@ -64,57 +86,147 @@ class KidneyBotConfig:
         self.owner_id = int(conf['ownerid'])
         self.report_channel = int(conf['report_channel'])
         self.perspective_api_key = conf.get('perspective_api_key')
+        # Point this at utils/fake_perspective.py to test automod offline.
+        self.perspective_url = conf.get('perspective_url', PERSPECTIVE_URL)
+        self.currency_write_behind = conf.get('currency_write_behind', False)
+        self.response_cache_dir = conf.get('response_cache_dir', 'cache')
+        self.loop_stall_threshold = conf.get('loop_stall_threshold', 0.5)
+        self.lexicon_path = conf.get('lexicon_path', 'data/lexicon.sqlite3')
+        self.sharded = conf.get('sharded', False)
+        self.shard_count = conf.get('shard_count')
+        self.shard_ids = None
+        # Set by launcher.py for each cluster process.
+        self.cluster_id = int(os.environ['KB_CLUSTER_ID']) if 'KB_CLUSTER_ID' in os.environ else None
+        self.ipc_port = int(os.environ['KB_IPC_PORT']) if 'KB_IPC_PORT' in os.environ else None
+        self.ipc_secret = os.environ.get('KB_IPC_SECRET')
+        if 'KB_SHARD_IDS' in os.environ:
+            self.sharded = True
+            self.shard_ids = [int(shard_id) for shard_id in os.environ['KB_SHARD_IDS'].split(',')]
+            self.shard_count = int(os.environ['KB_SHARD_COUNT'])
 
 
 with open('config.json', 'r') as f:
     config = KidneyBotConfig(json.load(f))
 
 
-class Bot(commands.Bot):
+class Bot(commands.AutoShardedBot if config.sharded else commands.Bot):
 
     def __init__(self, command_prefix, owner_id, intents):
+        shard_options = {'shard_count': config.shard_count, 'shard_ids': config.shard_ids} if config.sharded else {}
         super().__init__(
             command_prefix=command_prefix,
             owner_id=owner_id,
-            intents=intents
+            intents=intents,
+            **shard_options
         )
         import motor.motor_asyncio
         client = motor.motor_asyncio.AsyncIOMotorClient(config.dbstring)
         self.database = client.data
         self.config = config
+        self.settings = SettingsCache(self.database, on_change=lambda collection, guild: self.notify_clusters(
+            'settings_invalidate', {'collection': collection, 'guild': guild}))
+        self.blacklist = ScammerBlacklist(self.database.scammer_list)
+        self.rest_calls = Counter()
+        self.ledger = CurrencyLedger(self.database.currency) if config.currency_write_behind else None
+        self.leaderboard = Leaderboard(self.database.currency, self.get_guild)
+        self.log_dispatcher = LogDispatcher(self)
+        self.cluster_id = config.cluster_id
+        self.request_stats = RequestStats()
+        self.stall_detector = LoopStallDetector(config.loop_stall_threshold)
+        self.session = None
+        self.ledger_task = None
+        self.ipc = IPCClient(config.cluster_id, '127.0.0.1', config.ipc_port, config.ipc_secret) if config.ipc_port is not None else None
 
     async def setup_hook(self):
-        await self.tree.sync()
+        setup_start = time.perf_counter()
+        self.session = create_session(self.request_stats)
+        self.stall_detector.start()
+        if self.ipc is not None:
+            self.ipc.handlers = ipc_handlers
+            await self.ipc.connect()
+        await ensure_indexes(self.database)
+        # Commands are global, one cluster syncing them is enough.
+        synced = False
+        if self.cluster_id in [None, 0]:
+            synced = await self.sync_tree()
         self.add_view(cogs.activeguard.ReportView())
+        await self.blacklist.load()
+        self.loop.create_task(self.blacklist.run())
+        if self.ledger is not None:
+            self.ledger_task = self.loop.create_task(self.ledger.run())
+        await self.leaderboard.reconcile()
+        self.loop.create_task(self.leaderboard.run())
+        startup.mark('setup_hook')
+        logging.info(f'setup_hook finished in {time.perf_counter() - setup_start:.2f}s '
+                     f'({"with" if synced else "without"} command sync)')
+
+    def notify_clusters(self, op: str, data=None):
+        """Runs an IPC handler on every cluster without waiting for the answers. Does nothing without launcher.py."""
+        if self.ipc is None:
+            return
 
-    async def addcurrency(self, user: discord.User, value: int, location: str):
-        n = await self.database.currency.count_documents({"userID": str(user.id)})
-        if n == 1:
-            doc = await self.database.currency.find_one({"userID": str(user.id)})
-            if location == 'wallet':
-                await self.database.currency.update_one({'userID': str(user.id)},
-                                                        {'$set': {'wallet': str(int(doc['wallet']) + value)}})
-            elif location == 'bank':
-                await self.database.currency.update_one({'userID': str(user.id)},
-                                                        {'$set': {'bank': str(int(doc['bank']) + value)}})
-        else:
-            wallet, bank = (0, 0)
-            if location == 'wallet':
-                wallet = value
-            elif location == 'bank':
-                bank = value
-            await self.database.currency.insert_one({
-                "userID": str(user.id),
-                "wallet": str(wallet),
-                "bank": str(bank),
-                "inventory": []
-            })
+        async def notify():
+            try:
+                await self.ipc.request(op, data)
+            except Exception as e:
+                logging.error(f'Failed to notify clusters of {op}: {e!r}')
+        self.loop.create_task(notify())
+
+    def tree_hash(self) -> str:
+        # discord.py 2.4 added a required tree argument to to_dict().
+        payload = [command.to_dict(self.tree) if 'tree' in inspect.signature(command.to_dict).parameters
+                   else command.to_dict() for command in self.tree.get_commands()]
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    async def sync_tree(self, force: bool = False) -> bool:
+        """Syncs the command tree if it changed since the last sync. Returns whether a sync happened."""
+        tree_hash = self.tree_hash()
+        key = {'_id': f'command_tree:{self.application_id}'}
+        stored = await self.database.bot_state.find_one(key)
+        if not force and stored is not None and stored.get('hash') == tree_hash:
+            logging.info('Command tree unchanged, skipping sync.')
+            return False
+        start = time.perf_counter()
+        await self.tree.sync()
+        await self.database.bot_state.update_one(key, {'$set': {'hash': tree_hash, 'time': time.time()}}, upsert=True)
+        logging.info(f'Synced command tree in {time.perf_counter() - start:.2f}s.')
+        return True
+
+    async def close(self):
+        # Log embeds need the HTTP client, which super().close() shuts down along with the gateway.
+        await self.log_dispatcher.close()
+        await super().close()
+        # No more events can arrive, so this flush catches every payout, including ones made while logs drained.
+        if self.ledger_task is not None:
+            self.ledger_task.cancel()
+        if self.ledger is not None:
+            await self.ledger.close()
+        if self.session is not None:
+            await self.session.close()
+
+    async def addcurrency(self, user: discord.User, value: int, location: str, buffered: bool = False):
+        """Add value to a user's wallet or bank.
+
+        buffered=True lets small, frequent payouts go through the write-behind ledger when it is enabled in the config.
+        """
+        if location not in ['wallet', 'bank']:
+            raise ValueError(f"Parameter \"location\" must be 'wallet' or 'bank' got: {location}")
+        if buffered and self.ledger is not None:
+            self.ledger.add(str(user.id), int(value), location)
+            self.leaderboard.adjust(user, int(value))
+            return
+        # One atomic upsert, so concurrent payouts for the same user can't overwrite each other.
+        doc = await self.database.currency.find_one_and_update({'userID': str(user.id)},
+                                                               currency_update({location: int(value)}),
+                                                               projection={'total': 1}, upsert=True,
+                                                               return_document=ReturnDocument.AFTER)
+        self.leaderboard.record(user, doc['total'])
     
     async def log(self, guild: discord.Guild, actiontype: str, action: str, reason: str = None, user: discord.User = None, target: discord.User = None, message: discord.Message = None, color: discord.Color = None):
-        doc = await self.database.automodsettings.find_one({'guild': guild.id})
-        if doc is None:
+        settings = await self.settings.automod.get(guild.id)
+        if settings is None:
             return
-        if doc.get('log_channel') is None:
+        if settings.log_channel is None:
             return
 
         color = discord.Color.red() if color is None else color
@@ -126,7 +238,7 @@ class Bot(commands.Bot):
                               (f'**Message:** ```{message.content}```' if message is not None else ''),
                               color=color)
         embed.set_footer(text=f'Automated logging by kidney bot')
-        await self.get_channel(doc['log_channel']).send(embed=embed)
+        self.log_dispatcher.put(settings.log_channel, embed)
 
 
 bot = Bot(command_prefix=commands.when_mentioned_or('kb.'),
@@ -136,6 +248,71 @@ bot = Bot(command_prefix=commands.when_mentioned_or('kb.'),
 
 statuses = ["with the fate of the world", "minecraft"]
 
+ipc_handlers = {}
+
+
+def ipc_handler(op: str):
+    def decorator(func):
+        ipc_handlers[op] = func
+        return func
+    return decorator
+
+
+async def cluster_request(op: str, data=None) -> list:
+    """Runs an IPC handler on every cluster, or only in this process when not started by launcher.py."""
+    if bot.ipc is not None:
+        return await bot.ipc.request(op, data)
+    return [await ipc_handlers[op](data)]
+
+
+@ipc_handler('stats')
+async def ipc_stats(data):
+    latencies = dict(bot.latencies) if isinstance(bot, commands.AutoShardedBot) else {0: bot.latency}
+    guilds = Counter(guild.shard_id for guild in bot.guilds)
+    return {'cluster': bot.cluster_id or 0,
+            'shards': [{'id': shard_id, 'latency': latency, 'guilds': guilds[shard_id]}
+                       for shard_id, latency in sorted(latencies.items())]}
+
+
+@ipc_handler('owner_ids')
+async def ipc_owner_ids(data):
+    return [guild.owner_id for guild in bot.guilds if guild.owner_id is not None]
+
+
+@ipc_handler('settings_invalidate')
+async def ipc_settings_invalidate(data):
+    bot.settings.invalidate(data['collection'], data['guild'])
+
+
+@ipc_handler('blacklist_add')
+async def ipc_blacklist_add(data):
+    bot.blacklist.add(data)
+
+
+@ipc_handler('blacklist_remove')
+async def ipc_blacklist_remove(data):
+    bot.blacklist.remove(data)
+
+
+@ipc_handler('serverban')
+async def ipc_serverban(data):
+    guild = bot.get_guild(data['guild'])
+    if guild is None:
+        return None
+    embed = discord.Embed(title=f"{guild} has been banned.",
+                          description=f"Your server *{guild}* has been banned from using **{bot.user.name}**.",
+                          color=discord.Color.red())
+    embed.add_field(name=f"You can appeal by contacting __**{data['contact']}**__.", value="\u2800")
+    embed.add_field(name="Reason", value=f"```{data['reason']}```")
+    embed.set_footer(text=bot.user, icon_url=bot.user.avatar)
+    result = {'name': str(guild), 'owner': str(guild.owner)}
+    try:
+        await guild.owner.send(embed=embed)
+    except (AttributeError, discord.HTTPException):
+        pass
+    await guild.leave()
+    return result
+
 
 async def status():
     await bot.wait_until_ready()
@@ -148,6 +325,9 @@ async def status():
 @bot.listen('on_ready')
 async def on_ready():
     logging.info(f'We have logged in as {bot.user}')
+    if not any(name == 'ready' for name, *_ in startup.events):
+        startup.mark('ready')
+        logging.info(startup.report())
 
 
 @bot.listen('on_guild_join')
@@ -254,13 +434,71 @@ async def react(ctx, message: str, reaction: str):
 @bot.command()
 @commands.is_owner()
 async def announce(ctx, *, message: str):
-    await ctx.reply(f'Sent global message\n```{message}```')
-    ids = []
-    for guild in bot.guilds:
-        if int(guild.owner_id) not in ids:
-            await guild.owner.send(
-                f'Message from the dev!\n```{message}```(you are receiving this, because you own a server with this bot)')
-            ids.append(int(guild.owner_id))
+    broadcast = await Broadcast.create(bot, message)
+    await run_broadcast(ctx, broadcast, f'Sending global message\n```{message}```')
+
+
+@bot.command()
+@commands.is_owner()
+async def resumeannounce(ctx):
+    try:
+        broadcast = await Broadcast.latest_unfinished(bot)
+    except BroadcastRunning:
+        await ctx.reply('The latest announcement is still being sent, wait for it to finish or stop responding.')
+        return
+    if broadcast is None:
+        await ctx.reply('No unfinished announcement to resume.')
+        return
+    await run_broadcast(ctx, broadcast, f'Resuming global message\n```{broadcast.message}```')
+
+
+async def run_broadcast(ctx, broadcast: Broadcast, header: str):
+    status_message = await ctx.reply(f'{header}Starting...')
+
+    async def on_progress(progress: str):
+        await status_message.edit(content=f'{header}{progress}')
+
+    owner_ids = set(itertools.chain.from_iterable(await cluster_request('owner_ids')))
+    await broadcast.run(owner_ids, on_progress)
+    await status_message.edit(content=f'{header}Finished: {broadcast.progress()}')
+
+
+@bot.command()
+@commands.is_owner()
+async def perfstats(ctx):
+    lines = ['**Settings cache**'] + bot.settings.stats()
+    lines += ['**Blacklist index**', bot.blacklist.stats()]
+    if bot.ledger is not None:
+        lines += ['**Currency ledger**', bot.ledger.stats()]
+    lines += ['**Log dispatcher**', bot.log_dispatcher.stats()]
+    lines += ['**Event loop**', bot.stall_detector.stats()]
+    lines += ['**Outbound HTTP**'] + bot.request_stats.stats()
+    for cog in bot.cogs.values():
+        if hasattr(cog, 'perf_stats'):
+            lines += cog.perf_stats()
+    lines += ['**REST calls from event handlers**'] + [f'{handler}: {count}' for handler, count in bot.rest_calls.most_common()]
+    await ctx.reply('\n'.join(lines))
+
+
+@bot.command()
+@commands.is_owner()
+async def sync(ctx):
+    await bot.sync_tree(force=True)
+    await ctx.reply('Command tree synced.')
+
+
+@bot.command()
+@commands.is_owner()
+async def clusterstats(ctx):
+    lines = []
+    total = 0
+    for cluster in sorted(await cluster_request('stats'), key=lambda cluster: cluster['cluster']):
+        for shard in cluster['shards']:
+            lines.append(f"Cluster {cluster['cluster']} shard {shard['id']}: "
+                         f"{round(shard['latency'] * 1000)} ms, {shard['guilds']} guilds")
+            total += shard['guilds']
+    lines.append(f'**Total:** {total} guilds')
+    await ctx.reply('\n'.join(lines))
 
 
 @bot.command()
@@ -271,35 +509,26 @@ async def raiseexception(ctx):
 
 @bot.command()
 @commands.is_owner()
-async def serverban(ctx, guild: discord.Guild, *, text: str):
-    n = await bot.database.serverbans.count_documents({"id": str(guild.id)})
+async def serverban(ctx, guild: int, *, text: str):
+    n = await bot.database.serverbans.count_documents({"id": str(guild)})
     if n > 0:
-        await ctx.response.send_message("Server already banned!", ephemeral=True)
+        await ctx.reply("Server already banned!")
+        return
+    # The guild may be on another cluster, whichever one has it messages the owner and leaves.
+    results = [result for result in await cluster_request('serverban', {'guild': guild, 'reason': text,
+                                                                         'contact': str(ctx.message.author)}) if result]
+    if not results:
+        await ctx.reply("I'm not in that server!")
         return
     doc = {
-        "id": str(guild.id),
-        "name": str(guild),
-        "owner": str(guild.owner),
+        "id": str(guild),
+        "name": results[0]['name'],
+        "owner": results[0]['owner'],
         "reason": str(text)
     }
-    embed = discord.Embed(title=f"{guild} has been banned.",
-                          description=f"Your server *{guild}* has been banned from using **{bot.user.name}**.",
-                          color=discord.Color.red())
-    embed.add_field(name=f"You can appeal by contacting __**{ctx.message.author}**__.", value="\u2800")
-    embed.add_field(name="Reason", value=f"```{text}```")
-    embed.set_footer(text=bot.user, icon_url=bot.user.avatar)
-    await guild.owner.send(embed=embed)
-    """serverbandic[guild.id] = {
-        "name": str(guild),
-        "owner": str(guild.owner),
-        "reason": text
-    }
-    with open("serverbans.json", "w") as file:
-        json.dump(serverbandic, file)"""
+    await bot.database.serverbans.insert_one(doc)
     await ctx.reply(
-        f"Server *{guild}* has been permanently blacklisted from using **{bot.user.name}**")
-    bot.database.serverbans.insert_one(doc)
-    await guild.leave()
+        f"Server *{doc['name']}* has been permanently blacklisted from using **{bot.user.name}**")
 
 
 @bot.command()
@@ -328,12 +557,12 @@ async def createinvite(ctx, guild: discord.Guild):
 
 async def main():
     async with bot:
-        for filename in os.listdir('./cogs'):
-            if filename.endswith('.py'):
-                if not filename.startswith('-'):
-                    await bot.load_extension(f'cogs.{filename[:-3]}')
+        extensions = [f'cogs.{filename[:-3]}' for filename in os.listdir('./cogs')
+                      if filename.endswith('.py') and not filename.startswith('-')]
+        # Cogs don't depend on each other, so load them together.
+        await asyncio.gather(*(startup.measure(extension, bot.load_extension(extension)) for extension in extensions))
 
-        await bot.load_extension('jishaku')
+        await startup.measure('jishaku', bot.load_extension('jishaku'))
 
         asyncio.create_task(status())
 
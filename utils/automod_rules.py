@@ -0,0 +1,145 @@
+# Local automod rules that are checked before a message is sent to Perspective.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import functools
+import logging
+import re
+import time
+from collections import Counter, deque
+import regex
+
+DEFAULT_MIN_LENGTH = 3
+MAX_PATTERNS = 20
+MAX_PATTERN_LENGTH = 200
+# Per pattern per message. Guild regexes run on the event loop, a catastrophic one must not stall every guild.
+PATTERN_TIMEOUT = 0.002
+# A pattern that times out this often is switched off until the guild's rules change.
+MAX_TIMEOUTS = 3
+BLOCK = 'block'
+ALLOW = 'allow'
+
+# Whitespace, custom emoji and the common unicode emoji blocks. A message made only of these can't score on any
+# attribute, so there's no point asking.
+EMOJI_ONLY = re.compile(r'(?:\s|<a?:\w+:\d+>|[\u2190-\u2bff\u3030\u303d\ufe0f\u200d\U0001f000-\U0001faff])*')
+
+
+def trie_pattern(words: list[str]) -> str:
+    """One alternation built as a prefix trie, so the regex engine never retries a shared prefix.
+
+    This gets most of the benefit of Aho-Corasick while the matching itself stays in C.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node: dict) -> str:
+        end = '' in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if end:
+            body = '(?:' + body + ')?'
+        return body
+
+    return build(trie)
+
+
+def normalize_word(word: str) -> str:
+    return ' '.join(word.lower().split())
+
+
+def validate_pattern(pattern: str) -> str | None:
+    """Why a guild regex can't be used, or None if it's fine."""
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        return f'Patterns can be at most {MAX_PATTERN_LENGTH} characters long.'
+    try:
+        regex.compile(pattern)
+    except regex.error as e:
+        return f'Invalid regular expression: {e}'
+    return None
+
+
+class RuleSet:
+    """Compiled rules for one guild configuration. Use compile_rules() so identical configurations share one.
+
+    Word lists are one generated pattern and always cheap. Guild regexes run with the `regex` module so each search is
+    cut off after PATTERN_TIMEOUT, which bounds a message to roughly MAX_PATTERNS * PATTERN_TIMEOUT in the worst case.
+    """
+
+    def __init__(self, words: tuple[str, ...], patterns: tuple[str, ...], min_length: int):
+        self.min_length = min_length
+        self.words = None
+        # An empty word would make the pattern match everywhere. The command rejects them, hand edits might not.
+        words = sorted({normalize_word(word) for word in words} - {''})
+        if words:
+            self.words = re.compile(r'(?<!\w)' + trie_pattern(words) + r'(?!\w)', re.IGNORECASE)
+        self.patterns = []
+        for pattern in patterns[:MAX_PATTERNS]:
+            # Validated when added, but the database could have been edited by hand.
+            if validate_pattern(pattern) is None:
+                self.patterns.append(regex.compile(pattern, regex.IGNORECASE))
+        self.timeouts = Counter()
+
+    def check(self, text: str) -> tuple[str, str] | None:
+        """(verdict, rule) when a rule decides the message, None when it still needs to be scored."""
+        if self.words is not None:
+            match = self.words.search(text)
+            if match:
+                return BLOCK, f'word {match.group(0).lower()}'
+        for pattern in list(self.patterns):
+            try:
+                if pattern.search(text, timeout=PATTERN_TIMEOUT):
+                    return BLOCK, f'regex {pattern.pattern}'
+            except TimeoutError:
+                self.timeouts[pattern.pattern] += 1
+                if self.timeouts[pattern.pattern] >= MAX_TIMEOUTS:
+                    logging.warning(f'Disabling automod regex {pattern.pattern!r}, it keeps timing out.')
+                    self.patterns.remove(pattern)
+        if len(text.strip()) < self.min_length:
+            return ALLOW, 'min_length'
+        if EMOJI_ONLY.fullmatch(text):
+            return ALLOW, 'emoji_only'
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_rules(words: tuple[str, ...], patterns: tuple[str, ...], min_length: int) -> RuleSet:
+    return RuleSet(words, patterns, min_length)
+
+
+class RuleEngine:
+    """Runs a guild's rules and keeps per-rule hit counts and matching latency."""
+
+    def __init__(self):
+        self.hits = Counter()
+        self.checked = 0
+        self.timings = deque(maxlen=1000)
+
+    def check(self, settings, text: str) -> tuple[str, str] | None:
+        """`settings` is the guild's AutomodSettings, or None for a guild without any."""
+        start = time.perf_counter()
+        if settings is None:
+            rules = compile_rules((), (), DEFAULT_MIN_LENGTH)
+        else:
+            rules = compile_rules(tuple(settings.blocked_words), tuple(settings.blocked_patterns), settings.min_length)
+        result = rules.check(text)
+        self.timings.append(time.perf_counter() - start)
+        self.checked += 1
+        if result is not None:
+            self.hits[result[1]] += 1
+        return result
+
+    def stats(self) -> list[str]:
+        timings = sorted(self.timings)
+        decided = sum(self.hits.values())
+        lines = [f'rules: decided {decided}/{self.checked} messages locally']
+        if timings:
+            lines[0] += (f', p50 {timings[len(timings) // 2] * 1e6:.1f} us, '
+                         f'p99 {timings[int(len(timings) * 0.99)] * 1e6:.1f} us')
+        lines += [f'{rule}: {count}' for rule, count in self.hits.most_common(10)]
+        return lines
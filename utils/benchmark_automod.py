@@ -0,0 +1,165 @@
+# This utility load tests the automod cog against a fake Perspective API.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+"""
+Feeds synthetic guild messages to Automod.on_message at a fixed rate, with settings kept in memory and nothing sent
+to Discord. Starts utils/fake_perspective.py in-process unless --url is given.
+Example: python3 utils/benchmark_automod.py -r 200 -t 20 --error-rate 0.05
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+from types import SimpleNamespace
+from aiohttp import web
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from utils.settings_cache import SettingsCache, AI_DETECTION_ATTRIBUTES
+from utils.http_session import RequestStats, create_session
+from utils.fake_perspective import make_app, PATH
+from cogs.automod import Automod
+
+WORDS = ('the quick brown fox jumps over a lazy dog while everyone in the server talks about games music food '
+         'school work weather memes and whatever else comes up on a normal day').split()
+SPAM = ['JOIN MY SERVER NOW discord gg free', 'buy cheap followers here', 'you are all terrible people',
+        'check out my stream right now please']
+
+parser = argparse.ArgumentParser(prog='AutomodBenchmark', description='Measure automod throughput and verdict latency.')
+parser.add_argument('-r', '--rate', type=float, default=100, help='messages per second')
+parser.add_argument('-t', '--duration', type=float, default=10, help='seconds to send messages for')
+parser.add_argument('-g', '--guilds', type=int, default=20)
+parser.add_argument('--threshold', type=int, default=80, help='threshold set for every attribute in every guild')
+parser.add_argument('--blocked-words', nargs='*', default=['badword', 'scamlink'])
+parser.add_argument('--duplicate-rate', type=float, default=0.2, help='fraction of messages copied from a spam list')
+parser.add_argument('--short-rate', type=float, default=0.1, help='fraction of one or two character messages')
+parser.add_argument('--blocked-rate', type=float, default=0.02, help='fraction of messages with a blocked word')
+parser.add_argument('-w', '--workers', type=int, default=10, help='Perspective workers in the cog')
+parser.add_argument('--url', help='an already running Perspective stand-in')
+parser.add_argument('--port', type=int, default=8765)
+parser.add_argument('--latency', type=float, default=120)
+parser.add_argument('--jitter', type=float, default=40)
+parser.add_argument('--error-rate', type=float, default=0)
+parser.add_argument('--toxic-rate', type=float, default=0.1)
+
+args = parser.parse_args()
+
+
+class MemoryCollection:
+    """Just enough of a motor collection for GuildSettingsCache."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.docs = {}
+
+    async def find_one(self, query: dict):
+        return self.docs.get(query['guild'])
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        self.docs.setdefault(query['guild'], {'guild': query['guild']}).update(update['$set'])
+
+
+class Results:
+    def __init__(self):
+        self.latencies = []
+        self.deletions = 0
+        self.reasons = {}
+        self.errors = 0
+
+
+def message_text() -> str:
+    roll = random.random()
+    if roll < args.short_rate:
+        return random.choice(['k', 'ok', ':)', 'xd', '👍'])
+    roll -= args.short_rate
+    if roll < args.blocked_rate:
+        return f'{" ".join(random.choices(WORDS, k=5))} {random.choice(args.blocked_words)}'
+    roll -= args.blocked_rate
+    if roll < args.duplicate_rate:
+        return random.choice(SPAM)
+    return ' '.join(random.choices(WORDS, k=random.randint(4, 16)))
+
+
+def make_message(results: Results, guild_id: int, text: str):
+    async def delete():
+        results.deletions += 1
+
+    async def send(content):
+        pass
+
+    return SimpleNamespace(guild=SimpleNamespace(id=guild_id, me=None), content=text, delete=delete,
+                           author=SimpleNamespace(bot=False, send=send))
+
+
+async def main():
+    runner = None
+    url = args.url
+    if url is None:
+        app = make_app(args.latency, args.jitter, args.error_rate, args.toxic_rate)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', args.port).start()
+        url = f'http://127.0.0.1:{args.port}{PATH}'
+
+    results = Results()
+    database = SimpleNamespace(automodsettings=MemoryCollection('automodsettings'),
+                               ai_detection=MemoryCollection('ai_detection'),
+                               activeguardsettings=MemoryCollection('activeguardsettings'))
+    settings = SettingsCache(database)
+
+    async def log(guild, actiontype, action, reason=None, **kwargs):
+        results.reasons[action] = results.reasons.get(action, 0) + 1
+
+    request_stats = RequestStats()
+    bot = SimpleNamespace(settings=settings, session=create_session(request_stats), log=log,
+                          config=SimpleNamespace(perspective_api_key='benchmark', perspective_url=url))
+    for guild_id in range(args.guilds):
+        await settings.automod.update(guild_id, {'blocked_words': args.blocked_words})
+        await settings.ai_detection.update(guild_id, {'enabled': True} | {key: args.threshold for key in AI_DETECTION_ATTRIBUTES})
+
+    cog = Automod(bot)
+    cog.perspective.workers = args.workers
+    await cog.cog_load()
+
+    async def one(message):
+        start = time.perf_counter()
+        try:
+            await cog.on_message(message)
+        except Exception:
+            results.errors += 1
+        results.latencies.append(time.perf_counter() - start)
+
+    total = int(args.rate * args.duration)
+    tasks = []
+    start = time.perf_counter()
+    for i in range(total):
+        delay = start + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        message = make_message(results, random.randrange(args.guilds), message_text())
+        tasks.append(asyncio.create_task(one(message)))
+    send_time = time.perf_counter() - start
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    await cog.cog_unload()
+    await bot.session.close()
+    if runner is not None:
+        await runner.cleanup()
+
+    latencies = sorted(results.latencies)
+    print(f'sent {total} messages in {send_time:.1f}s ({total / send_time:.0f}/s, target {args.rate:.0f}/s), '
+          f'all verdicts in {elapsed:.1f}s ({total / elapsed:.0f}/s)')
+    print('verdict latency: ' + ', '.join(f'p{p} {latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] * 1000:.1f} ms'
+                                          for p in (50, 95, 99)) + f', max {latencies[-1] * 1000:.1f} ms')
+    print(f'deleted {results.deletions} messages ' +
+          ', '.join(f'{count} by {action}' for action, count in results.reasons.items()) +
+          f', {results.errors} handler errors')
+    print('\n'.join(cog.perf_stats()))
+    print('\n'.join(request_stats.stats()))
+
+
+asyncio.run(main())
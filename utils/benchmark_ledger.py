@@ -0,0 +1,84 @@
+# This utility compares direct currency writes with the write-behind ledger.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+"""
+Runs against a scratch collection (currency_benchmark by default) that is dropped before and after the run,
+so it never touches real balances. Example: python3 utils/benchmark_ledger.py -n 5000 -u 200
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import motor.motor_asyncio
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from utils.ledger import CurrencyLedger, currency_update
+
+parser = argparse.ArgumentParser(prog='LedgerBenchmark', description='Measure payout throughput with and without the ledger.')
+parser.add_argument('-d', '--database_conn_string', help='defaults to dbstring in config.json')
+parser.add_argument('-c', '--collection', default='currency_benchmark')
+parser.add_argument('-n', '--payouts', type=int, default=2000)
+parser.add_argument('-u', '--users', type=int, default=100)
+parser.add_argument('--concurrency', type=int, default=50)
+
+args = parser.parse_args()
+
+if args.database_conn_string is None:
+    with open(os.path.join(os.path.dirname(__file__), os.pardir, 'config.json'), 'r') as f:
+        args.database_conn_string = json.load(f)['dbstring']
+
+
+async def run(payout):
+    payouts = [(str(random.randrange(args.users)), random.randint(0, 100)) for _ in range(args.payouts)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(user_id, amount):
+        async with semaphore:
+            await payout(user_id, amount)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(user_id, amount) for user_id, amount in payouts))
+    return start, sum(amount for _, amount in payouts)
+
+
+async def main():
+    collection = motor.motor_asyncio.AsyncIOMotorClient(args.database_conn_string).data[args.collection]
+
+    await collection.drop()
+    await collection.create_index('userID', unique=True)
+
+    async def direct(user_id, amount):
+        await collection.update_one({'userID': user_id}, currency_update({'wallet': amount}), upsert=True)
+
+    start, expected = await run(direct)
+    direct_time = time.perf_counter() - start
+
+    await collection.delete_many({})
+    ledger = CurrencyLedger(collection)
+
+    async def buffered(user_id, amount):
+        ledger.add(user_id, amount, 'wallet')
+
+    start, expected = await run(buffered)
+    await ledger.close()
+    ledger_time = time.perf_counter() - start
+
+    stored = 0
+    async for doc in collection.find({}, {'wallet': 1}):
+        stored += doc['wallet']
+
+    print(f'{args.payouts} payouts across {args.users} users')
+    print(f'direct: {direct_time:.2f}s ({args.payouts / direct_time:.0f} payouts/s, {args.payouts} writes)')
+    print(f'ledger: {ledger_time:.2f}s ({args.payouts / ledger_time:.0f} payouts/s, {ledger.writes} writes '
+          f'in {ledger.flushes} flushes)')
+    print(f'ledger total {"matches" if stored == expected else "DOES NOT MATCH"} the payouts ({stored}/{expected})')
+
+    await collection.drop()
+
+
+asyncio.run(main())
@@ -0,0 +1,57 @@
+# This utility compares local lexicon lookups with the Datamuse API.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+"""
+python3 utils/benchmark_lexicon.py [-l data/lexicon.sqlite3] [-n 20] word ...
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import aiohttp
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from utils.lexicon import Lexicon
+
+parser = argparse.ArgumentParser(prog='LexiconBenchmark', description='Time local lookups against Datamuse.')
+parser.add_argument('words', nargs='*', default=['happy', 'big', 'fast', 'good', 'cold', 'light', 'strong', 'run'])
+parser.add_argument('-l', '--lexicon', default=os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'lexicon.sqlite3'))
+parser.add_argument('-n', '--rounds', type=int, default=3, help='remote requests per word')
+
+args = parser.parse_args()
+
+
+def summarize(name: str, timings: list[float]):
+    if not timings:
+        return
+    timings = sorted(timings)
+    print(f'{name}: {len(timings)} lookups, p50 {timings[len(timings) // 2] * 1e6:.1f} us, '
+          f'p99 {timings[int(len(timings) * 0.99)] * 1e6:.1f} us')
+
+
+async def main():
+    lexicon = Lexicon(args.lexicon)
+    local = []
+    for _ in range(10000 // len(args.words)):
+        for word in args.words:
+            for relation in ['rel_syn', 'rel_ant']:
+                start = time.perf_counter()
+                lexicon.lookup(word, relation)
+                local.append(time.perf_counter() - start)
+    summarize('lexicon', local)
+
+    remote = []
+    async with aiohttp.ClientSession() as session:
+        for _ in range(args.rounds):
+            for word in args.words:
+                start = time.perf_counter()
+                async with session.get('https://api.datamuse.com/words', params={'rel_syn': word}) as r:
+                    await r.json()
+                remote.append(time.perf_counter() - start)
+    summarize('datamuse', remote)
+
+
+asyncio.run(main())
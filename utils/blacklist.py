@@ -0,0 +1,75 @@
+# In-memory index of the global scammer blacklist.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import logging
+import sys
+import time
+
+
+class ScammerBlacklist:
+    """Set of blacklisted user ids mirrored from the scammer_list collection.
+
+    ReportView updates the index directly when it writes and tells other clusters over IPC. Other writers are picked
+    up by a background refresh that only reads documents newer than the last seen `time`, with a periodic full reload
+    to catch removals.
+    """
+
+    def __init__(self, collection, refresh_interval: float = 60, full_reload_every: int = 30):
+        self.collection = collection
+        self.refresh_interval = refresh_interval
+        self.full_reload_every = full_reload_every
+        self.watermark = 0.0
+        self.last_refresh = None
+        self.refreshes = 0
+        self._users = set()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def add(self, user_id: int):
+        self._users.add(user_id)
+
+    def remove(self, user_id: int):
+        self._users.discard(user_id)
+
+    async def load(self):
+        users = set()
+        watermark = 0.0
+        async for doc in self.collection.find({}, {'user': 1, 'time': 1}):
+            users.add(doc['user'])
+            watermark = max(watermark, doc.get('time') or 0.0)
+        self._users = users
+        self.watermark = watermark
+        self.last_refresh = time.time()
+        logging.info(f'Loaded {len(users)} users into the scammer blacklist index.')
+
+    async def refresh(self):
+        # $gte so documents sharing the watermark timestamp aren't missed, adding them twice is harmless.
+        async for doc in self.collection.find({'time': {'$gte': self.watermark}}, {'user': 1, 'time': 1}):
+            self._users.add(doc['user'])
+            self.watermark = max(self.watermark, doc.get('time') or 0.0)
+        self.last_refresh = time.time()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            self.refreshes += 1
+            try:
+                if self.refreshes % self.full_reload_every == 0:
+                    await self.load()
+                else:
+                    await self.refresh()
+            except Exception as e:
+                logging.error(f'Failed to refresh scammer blacklist index: {e}')
+
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self._users) + sum(sys.getsizeof(user) for user in self._users)
+
+    def stats(self) -> str:
+        age = f'{time.time() - self.last_refresh:.0f}s ago' if self.last_refresh is not None else 'never'
+        return f'scammer_list: {len(self)} users, {self.memory_usage() / 1024:.1f} KiB, last refresh {age}'
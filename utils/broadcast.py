@@ -0,0 +1,147 @@
+# Sends a DM to every guild owner, concurrently and resumably.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import logging
+import time
+import uuid
+import discord
+from pymongo import ReturnDocument
+
+# A running broadcast whose heartbeat is older than this is assumed to have died with its process.
+STALE_AFTER = 60
+
+
+class BroadcastRunning(Exception):
+    """The unfinished broadcast is still being sent by a live process."""
+
+
+class RateLimiter:
+    """Lets at most `rate` calls start per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+            self._next = max(now, self._next) + self.interval
+
+
+class Broadcast:
+    """One announce run, with progress stored in the broadcasts collection.
+
+    Sent and failed recipients are checkpointed every `checkpoint_interval` seconds, so resuming after a crash
+    re-sends to at most the owners messaged since the last checkpoint. Each checkpoint also refreshes the run's
+    heartbeat, which is how a resume tells a crashed run from one that is still sending.
+    """
+
+    def __init__(self, bot, doc: dict, concurrency: int = 5, rate: float = 4, checkpoint_interval: float = 5):
+        self.bot = bot
+        self.collection = bot.database.broadcasts
+        self.id = doc['_id']
+        self.message = doc['message']
+        self.sent = set(doc.get('sent', []))
+        self.failed = set(doc.get('failed', []))
+        self.recipients = set()
+        self.concurrency = concurrency
+        self.checkpoint_interval = checkpoint_interval
+        self._limiter = RateLimiter(rate)
+        self._new_sent = []
+        self._new_failed = []
+
+    @classmethod
+    async def create(cls, bot, message: str) -> 'Broadcast':
+        doc = {'_id': str(uuid.uuid4()), 'message': message, 'status': 'running', 'started': time.time(),
+               'heartbeat': time.time(), 'sent': [], 'failed': []}
+        await bot.database.broadcasts.insert_one(doc)
+        return cls(bot, doc)
+
+    @classmethod
+    async def latest_unfinished(cls, bot) -> 'Broadcast | None':
+        """The newest unfinished run, claimed for this process. Raises BroadcastRunning if it is still live."""
+        collection = bot.database.broadcasts
+        doc = await collection.find_one({'status': 'running'}, sort=[('started', -1)])
+        if doc is None:
+            return None
+        # Runs from before heartbeats existed only have a start time.
+        if doc.get('heartbeat', doc['started']) > time.time() - STALE_AFTER:
+            raise BroadcastRunning(doc['_id'])
+        # Only succeeds if nobody refreshed the heartbeat since it was read, so two resumes can't both send.
+        claimed = await collection.find_one_and_update({'_id': doc['_id'], 'status': 'running',
+                                                        'heartbeat': doc.get('heartbeat')},
+                                                       {'$set': {'heartbeat': time.time()}},
+                                                       return_document=ReturnDocument.AFTER)
+        if claimed is None:
+            raise BroadcastRunning(doc['_id'])
+        return cls(bot, claimed)
+
+    @property
+    def remaining(self) -> int:
+        return len(self.recipients - self.sent - self.failed)
+
+    def progress(self) -> str:
+        return f'sent {len(self.sent)}, failed {len(self.failed)}, remaining {self.remaining}'
+
+    async def checkpoint(self):
+        sent, self._new_sent = self._new_sent, []
+        failed, self._new_failed = self._new_failed, []
+        update = {'$set': {'heartbeat': time.time()}}
+        if sent or failed:
+            update['$addToSet'] = {'sent': {'$each': sent}, 'failed': {'$each': failed}}
+        await self.collection.update_one({'_id': self.id}, update)
+
+    async def _send(self, owner_id: int):
+        await self._limiter.wait()
+        try:
+            owner = self.bot.get_user(owner_id) or await self.bot.fetch_user(owner_id)
+            await owner.send(f'Message from the dev!\n```{self.message}```'
+                             f'(you are receiving this, because you own a server with this bot)')
+        except Exception as e:
+            # Anything escaping here would fail the gather in run() and leave the other workers unchecked.
+            level = logging.DEBUG if isinstance(e, discord.HTTPException) else logging.WARNING
+            logging.log(level, f'Announce {self.id}: could not message {owner_id}: {e!r}')
+            self.failed.add(owner_id)
+            self._new_failed.append(owner_id)
+        else:
+            self.sent.add(owner_id)
+            self._new_sent.append(owner_id)
+
+    async def run(self, recipients: set[int] = None, on_progress=None):
+        """Messages every recipient not already handled, by default the owners of this process' guilds.
+        on_progress is awaited with a progress string while running."""
+        if recipients is None:
+            recipients = {guild.owner_id for guild in self.bot.guilds if guild.owner_id is not None}
+        self.recipients = recipients
+        pending = self.recipients - self.sent - self.failed
+        queue = asyncio.Queue()
+        for owner_id in pending:
+            queue.put_nowait(owner_id)
+
+        async def worker():
+            while not queue.empty():
+                await self._send(queue.get_nowait())
+
+        workers = asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        try:
+            while not workers.done():
+                await asyncio.wait([workers], timeout=self.checkpoint_interval)
+                await self.checkpoint()
+                if on_progress is not None:
+                    await on_progress(self.progress())
+            await workers
+        except BaseException:
+            # Stop sending before recording progress, so nobody is messaged without being checkpointed.
+            workers.cancel()
+            await asyncio.gather(workers, return_exceptions=True)
+            await self.checkpoint()
+            # Nothing is sending any more, it can be resumed right away.
+            await self.collection.update_one({'_id': self.id}, {'$set': {'heartbeat': 0}})
+            raise
+        await self.collection.update_one({'_id': self.id}, {'$set': {'status': 'finished', 'finished': time.time()}})
+        logging.info(f'Announce {self.id} finished: {self.progress()}')
@@ -0,0 +1,107 @@
+# This utility builds the local synonym/antonym lexicon from WordNet.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+"""
+Download WordNet 3.x (https://wordnet.princeton.edu/download or Open English WordNet in WNDB format) and point this
+script at its dict directory: python3 utils/build_lexicon.py path/to/dict
+Writes data/lexicon.sqlite3 by default, which the fun cog picks up on the next start.
+"""
+
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from utils.lexicon import RELATIONS
+
+MAX_RELATED = 10
+FILES = {'n': 'data.noun', 'v': 'data.verb', 'a': 'data.adj', 'r': 'data.adv'}
+
+parser = argparse.ArgumentParser(prog='LexiconBuilder', description='Build the synonym/antonym lexicon from WordNet.')
+parser.add_argument('wordnet_dir')
+parser.add_argument('-o', '--output', default=os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'lexicon.sqlite3'))
+
+args = parser.parse_args()
+
+
+def clean(word: str) -> str:
+    # Adjectives can carry a syntactic marker like "(a)", multi word entries use underscores.
+    return re.sub(r'\(.*\)$', '', word).replace('_', ' ').lower()
+
+
+def parse(path: str, pos: str, synsets: dict):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith(' '):
+                continue  # license header
+            fields = line.split(' | ')[0].split()
+            offset = fields[0]
+            word_count = int(fields[3], 16)
+            words = [clean(fields[4 + i * 2]) for i in range(word_count)]
+            i = 4 + word_count * 2
+            pointer_count = int(fields[i])
+            pointers = [fields[i + 1 + j * 4:i + 5 + j * 4] for j in range(pointer_count)]
+            # Satellite adjectives live in data.adj but are referenced with pos "s".
+            synsets[(offset, pos)] = (words, pointers)
+
+
+def add(related: dict, word: str, other: str):
+    words = related.setdefault(word, [])
+    if other != word and other not in words:
+        words.append(other)
+
+
+def main():
+    start = time.perf_counter()
+    synsets = {}
+    for pos, filename in FILES.items():
+        parse(os.path.join(args.wordnet_dir, filename), pos, synsets)
+    for (offset, pos), value in list(synsets.items()):
+        if pos == 'a':
+            synsets.setdefault((offset, 's'), value)
+    print(f'parsed {len(synsets)} synsets in {time.perf_counter() - start:.1f}s')
+
+    synonyms, antonyms = {}, {}
+    for (offset, pos), (words, pointers) in synsets.items():
+        if pos == 's':
+            continue
+        for word in words:
+            synonyms.setdefault(word, [])
+            antonyms.setdefault(word, [])
+            for other in words:
+                add(synonyms, word, other)
+        for symbol, target_offset, target_pos, source_target in pointers:
+            target = synsets.get((target_offset, target_pos))
+            if target is None:
+                continue
+            if symbol == '!':
+                source, target_word = int(source_target[:2], 16), int(source_target[2:], 16)
+                add(antonyms, words[source - 1], target[0][target_word - 1])
+            elif symbol == '&':
+                # Similar adjectives, a useful source of synonyms for words with small synsets.
+                for word in words:
+                    for other in target[0]:
+                        add(synonyms, word, other)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    db = sqlite3.connect(args.output)
+    db.execute('CREATE TABLE lexicon (word TEXT, relation INTEGER, related TEXT, PRIMARY KEY (word, relation)) '
+               'WITHOUT ROWID')
+    for relation, table in [('rel_syn', synonyms), ('rel_ant', antonyms)]:
+        db.executemany('INSERT INTO lexicon VALUES (?, ?, ?)',
+                       ((word, RELATIONS[relation], '|'.join(related[:MAX_RELATED]))
+                        for word, related in table.items() if related))
+    db.commit()
+    db.execute('VACUUM')
+    db.close()
+    print(f'wrote {len(synonyms)} words to {args.output} ({os.path.getsize(args.output) / 2 ** 20:.1f} MiB) '
+          f'in {time.perf_counter() - start:.1f}s')
+
+
+main()
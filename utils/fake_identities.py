@@ -0,0 +1,107 @@
+# Long-lived Faker instances and a buffer of ready fake identities.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import itertools
+import time
+from collections import deque
+from utils.lazy_import import LazyModule
+
+faker = LazyModule('faker')
+
+
+class FakerPool:
+    """Reuses Faker instances, which are slow to construct, and keeps identities ready ahead of time.
+
+    Instances are seeded with seed, seed + 1, ... when a seed is given, so output is reproducible.
+    Nothing is built until the first identity() call, which keeps faker out of memory for bots that never use it.
+    That call builds the instances off the event loop and starts a task keeping `buffer_size` identities ready.
+    """
+
+    def __init__(self, size: int = 2, seed: int = None, buffer_size: int = 50):
+        self.size = size
+        self.seed = seed
+        self.buffer_size = buffer_size
+        self.hits = 0
+        self.misses = 0
+        self._fakers = []
+        self._cycle = None
+        self._buffer = deque()
+        self._wanted = asyncio.Event()
+        self._build_lock = asyncio.Lock()
+        self._task = None
+
+    def _build(self):
+        fakers = []
+        for i in range(self.size):
+            fake = faker.Faker()
+            if self.seed is not None:
+                fake.seed_instance(self.seed + i)
+            fakers.append(fake)
+        self._fakers = fakers
+        self._cycle = itertools.cycle(fakers)
+
+    def generate(self) -> tuple[str, str]:
+        if self._cycle is None:
+            self._build()
+        fake = next(self._cycle)
+        return fake.name(), fake.address()
+
+    async def _ensure_built(self):
+        async with self._build_lock:
+            if self._cycle is None:
+                await asyncio.to_thread(self._build)
+
+    async def identity(self) -> tuple[str, str]:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        self._wanted.set()
+        if self._buffer:
+            self.hits += 1
+            return self._buffer.popleft()
+        self.misses += 1
+        await self._ensure_built()
+        return self.generate()
+
+    async def run(self):
+        await self._ensure_built()
+        while True:
+            while len(self._buffer) < self.buffer_size:
+                self._buffer.append(self.generate())
+                # Generating one takes well under a millisecond, yield between them anyway.
+                await asyncio.sleep(0)
+            self._wanted.clear()
+            await self._wanted.wait()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        return f'fake-info: {len(self._buffer)}/{self.buffer_size} ready, {self.hits}/{total} served from buffer'
+
+
+def benchmark(calls: int = 200):
+    """Run from the repository root with: python3 -m utils.fake_identities"""
+    start = time.perf_counter()
+    for _ in range(calls):
+        fake = faker.Faker()
+        fake.name(), fake.address()
+    per_call = (time.perf_counter() - start) / calls
+
+    pool = FakerPool()
+    pool.generate()
+    start = time.perf_counter()
+    for _ in range(calls):
+        pool.generate()
+    pooled = (time.perf_counter() - start) / calls
+
+    print(f'Faker() per call: {per_call * 1000:.2f} ms')
+    print(f'pooled instance:  {pooled * 1000:.3f} ms ({per_call / pooled:.0f}x faster)')
+    print('buffered identity: a deque pop, effectively constant time')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,72 @@
+# A local stand-in for the Perspective API, for load testing automod without a key.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+"""
+python3 utils/fake_perspective.py [--port 8765] [--latency 120] [--jitter 40] [--error-rate 0.01] [--toxic-rate 0.1]
+Then set "perspective_url": "http://127.0.0.1:8765/v1alpha1/comments:analyze" in config.json.
+"""
+
+import os
+import sys
+import random
+import asyncio
+import hashlib
+import argparse
+from aiohttp import web
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from utils.settings_cache import AI_DETECTION_ATTRIBUTES
+
+PATH = '/v1alpha1/comments:analyze'
+
+
+def fake_scores(text: str, toxic_rate: float, attributes: list[str]) -> dict:
+    """Scores depend only on the text, so repeated messages score the same like they do with the real API."""
+    rng = random.Random(hashlib.sha256(text.encode()).digest())
+    toxic = set(rng.sample(attributes, rng.randint(1, 3))) if rng.random() < toxic_rate else set()
+    return {attribute: rng.uniform(0.7, 1) if attribute in toxic else rng.uniform(0, 0.3) for attribute in attributes}
+
+
+def make_app(latency: float = 120, jitter: float = 40, error_rate: float = 0, toxic_rate: float = 0.1) -> web.Application:
+    """Latency and jitter are in milliseconds. Errors are 503s, or 429s for a quarter of them."""
+    app = web.Application()
+    app['requests'] = 0
+    app['errors'] = 0
+
+    async def analyze(request: web.Request) -> web.Response:
+        app['requests'] += 1
+        await asyncio.sleep(max(0.0, random.gauss(latency, jitter)) / 1000)
+        if random.random() < error_rate:
+            app['errors'] += 1
+            status = 429 if random.random() < 0.25 else 503
+            return web.json_response({'error': {'code': status, 'message': 'Injected failure'}}, status=status)
+        try:
+            body = await request.json()
+            text = body['comment']['text']
+            requested = [attribute for attribute in body['requestedAttributes'] if attribute in AI_DETECTION_ATTRIBUTES]
+        except (ValueError, KeyError, TypeError):
+            return web.json_response({'error': {'code': 400, 'message': 'Invalid JSON payload'}}, status=400)
+        if not text:
+            return web.json_response({'error': {'code': 400, 'message': 'Comment must be non-empty.'}}, status=400)
+        scores = fake_scores(text, toxic_rate, requested)
+        return web.json_response({
+            'attributeScores': {attribute: {'summaryScore': {'value': value, 'type': 'PROBABILITY'}}
+                                for attribute, value in scores.items()},
+            'languages': ['en'],
+        })
+
+    app.router.add_post(PATH, analyze)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='FakePerspective', description='Serve fake Perspective API scores locally.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=120, help='mean response time in ms')
+    parser.add_argument('--jitter', type=float, default=40, help='standard deviation of the response time in ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail with 503/429')
+    parser.add_argument('--toxic-rate', type=float, default=0.1, help='fraction of distinct messages that score high')
+    args = parser.parse_args()
+    web.run_app(make_app(args.latency, args.jitter, args.error_rate, args.toxic_rate), host=args.host, port=args.port)
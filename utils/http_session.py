@@ -0,0 +1,57 @@
+# Shared aiohttp session for all outbound HTTP requests.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+import aiohttp
+
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=200)
+
+    def percentile(self, p: float) -> float:
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] if latencies else 0.0
+
+
+class RequestStats:
+    """Per-host request counts and latencies, collected through aiohttp's tracing hooks."""
+
+    def __init__(self):
+        self.hosts = defaultdict(HostStats)
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_request_start.append(self._on_start)
+        self.trace_config.on_request_end.append(self._on_end)
+        self.trace_config.on_request_exception.append(self._on_exception)
+
+    async def _on_start(self, session, context: SimpleNamespace, params):
+        context.start = time.perf_counter()
+
+    async def _on_end(self, session, context: SimpleNamespace, params):
+        stats = self.hosts[params.url.host]
+        stats.requests += 1
+        stats.latencies.append(time.perf_counter() - context.start)
+
+    async def _on_exception(self, session, context: SimpleNamespace, params):
+        stats = self.hosts[params.url.host]
+        stats.requests += 1
+        stats.errors += 1
+
+    def stats(self) -> list[str]:
+        return [f'{host}: {stats.requests} requests, {stats.errors} errors, '
+                f'p50 {stats.percentile(0.5) * 1000:.0f} ms, p95 {stats.percentile(0.95) * 1000:.0f} ms'
+                for host, stats in sorted(self.hosts.items(), key=lambda item: -item[1].requests)]
+
+
+def create_session(stats: RequestStats, limit: int = 100, limit_per_host: int = 10, timeout: float = 15,
+                   dns_ttl: int = 300) -> aiohttp.ClientSession:
+    """Must be called with the event loop running, e.g. from setup_hook."""
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host, ttl_dns_cache=dns_ttl,
+                                     keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout),
+                                 trace_configs=[stats.trace_config])
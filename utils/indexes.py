@@ -0,0 +1,89 @@
+# Declares and verifies the database indexes the bot relies on.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import logging
+from pymongo.errors import OperationFailure
+
+# collection: [(keys, options)]
+# Unique where the code assumes one document per key.
+REQUIRED_INDEXES = {
+    'currency': [([('userID', 1)], {'unique': True}),
+                 ([('total', -1)], {})],
+    'scammer_list': [([('user', 1)], {'unique': True}),
+                     ([('time', 1)], {})],
+    'reports': [([('report_id', 1)], {'unique': True}),
+                ([('reported_user', 1)], {})],
+    'serverbans': [([('id', 1)], {'unique': True})],
+    'broadcasts': [([('status', 1), ('started', -1)], {})],
+    'ai_detection': [([('guild', 1)], {'unique': True})],
+    'automodsettings': [([('guild', 1)], {'unique': True})],
+    # Older documents were keyed by guild_id, sparse so they don't collide on a missing guild.
+    'activeguardsettings': [([('guild', 1)], {'unique': True, 'sparse': True})],
+}
+
+# The queries the hot paths run, checked with explain() at startup.
+HOT_QUERIES = {
+    'currency': {'userID': '0'},
+    'scammer_list': {'time': {'$gte': 0}},
+    'reports': {'report_id': ''},
+    'serverbans': {'id': '0'},
+    'ai_detection': {'guild': 0},
+    'automodsettings': {'guild': 0},
+    'activeguardsettings': {'guild': 0},
+}
+
+
+def index_name(keys: list) -> str:
+    return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+
+def plan_stages(plan: dict) -> list[str]:
+    stages = []
+    while plan is not None:
+        stages.append(plan.get('stage'))
+        plan = plan.get('inputStage')
+    return stages
+
+
+async def ensure_indexes(database) -> bool:
+    """Creates missing indexes and logs a report. Returns False if any index couldn't be created."""
+    ok = True
+    for collection, indexes in REQUIRED_INDEXES.items():
+        for keys, options in indexes:
+            try:
+                await database[collection].create_index(keys, name=index_name(keys), **options)
+            except OperationFailure as e:
+                # Usually duplicate documents blocking a unique index, the bot still works without it, just slower.
+                logging.error(f'Could not create index {index_name(keys)} on {collection}: {e}')
+                if collection == 'currency':
+                    logging.error('Run utils/migrate_currency.py to merge duplicate currency documents.')
+                ok = False
+    await log_index_report(database)
+    return ok
+
+
+async def log_index_report(database):
+    for collection, indexes in REQUIRED_INDEXES.items():
+        declared = {index_name(keys) for keys, _ in indexes} | {'_id_'}
+        existing = await database[collection].index_information()
+        missing = declared - set(existing)
+        if missing:
+            logging.warning(f'{collection}: missing indexes {", ".join(sorted(missing))}')
+
+        try:
+            async for stats in database[collection].aggregate([{'$indexStats': {}}]):
+                if stats['accesses']['ops'] == 0 and stats['name'] != '_id_':
+                    logging.info(f'{collection}: index {stats["name"]} has not been used since {stats["accesses"]["since"]}')
+                if stats['name'] not in declared:
+                    logging.info(f'{collection}: index {stats["name"]} is not declared in utils/indexes.py')
+        except OperationFailure:
+            # $indexStats needs the clusterMonitor role on some hosted plans.
+            pass
+
+        query = HOT_QUERIES.get(collection)
+        if query is not None:
+            explain = await database[collection].find(query).explain()
+            stages = plan_stages(explain['queryPlanner']['winningPlan'])
+            log = logging.warning if 'COLLSCAN' in stages else logging.info
+            log(f'{collection}: {query} -> {" <- ".join(stages)}')
@@ -0,0 +1,143 @@
+# Minimal IPC between the cluster launcher and bot processes.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+"""
+Messages are JSON objects, one per line, over a local TCP connection.
+A cluster asks the launcher with {"id", "op", "data"}. The launcher forwards the op to every cluster (including the
+one asking), collects their {"reply_to", "data"} answers and replies with {"reply_to", "data": [answers]}.
+Every connection has to start with {"op": "register", "cluster", "secret"}, using the secret the launcher passes in
+KB_IPC_SECRET, or it is closed.
+"""
+
+import asyncio
+import hmac
+import itertools
+import json
+import logging
+
+# owner id lists for every guild can be far larger than asyncio's default 64 KiB line limit.
+STREAM_LIMIT = 2 ** 24
+
+
+async def send_message(writer: asyncio.StreamWriter, message: dict):
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+
+
+class IPCServer:
+    """Runs in the launcher and fans requests out to every connected cluster."""
+
+    def __init__(self, secret: str, host: str = '127.0.0.1', port: int = 0, timeout: float = 10):
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.clusters = {}
+        self._ids = itertools.count()
+        self._pending = {}
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=STREAM_LIMIT)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        cluster_id = None
+        try:
+            # Any local process can reach the port, so nothing is read or forwarded before a valid register.
+            message = json.loads(await asyncio.wait_for(reader.readline(), self.timeout) or 'null')
+            if (not isinstance(message, dict) or message.get('op') != 'register'
+                    or not hmac.compare_digest(str(message.get('secret', '')), self.secret)):
+                logging.warning(f'Rejected IPC connection from {writer.get_extra_info("peername")}.')
+                writer.close()
+                return
+            cluster_id = message['cluster']
+            self.clusters[cluster_id] = writer
+            logging.info(f'Cluster {cluster_id} connected to IPC.')
+            while line := await reader.readline():
+                message = json.loads(line)
+                if 'reply_to' in message:
+                    future = self._pending.get(message['reply_to'], {}).get(cluster_id)
+                    if future is not None and not future.done():
+                        future.set_result(message.get('data'))
+                else:
+                    asyncio.create_task(self._fan_out(writer, message))
+        except (ConnectionError, asyncio.TimeoutError, json.JSONDecodeError, KeyError) as e:
+            logging.warning(f'IPC connection from cluster {cluster_id} failed: {e}')
+            writer.close()
+        finally:
+            if cluster_id is not None and self.clusters.get(cluster_id) is writer:
+                del self.clusters[cluster_id]
+                logging.info(f'Cluster {cluster_id} disconnected from IPC.')
+
+    async def _fan_out(self, requester: asyncio.StreamWriter, message: dict):
+        request_id = next(self._ids)
+        loop = asyncio.get_running_loop()
+        futures = {cluster_id: loop.create_future() for cluster_id in self.clusters}
+        self._pending[request_id] = futures
+        try:
+            for cluster_id, writer in list(self.clusters.items()):
+                await send_message(writer, {'id': request_id, 'op': message['op'], 'data': message.get('data')})
+            done, _ = await asyncio.wait(futures.values(), timeout=self.timeout) if futures else (set(), set())
+        finally:
+            del self._pending[request_id]
+        answers = [future.result() for future in futures.values() if future in done]
+        await send_message(requester, {'reply_to': message['id'], 'data': answers})
+
+
+class IPCClient:
+    """Runs in each bot process. Handlers answer ops forwarded by the launcher."""
+
+    def __init__(self, cluster_id: int, host: str, port: int, secret: str, timeout: float = 15):
+        self.cluster_id = cluster_id
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.handlers = {}
+        self._ids = itertools.count()
+        self._pending = {}
+        self._writer = None
+
+    def handler(self, op: str):
+        def decorator(func):
+            self.handlers[op] = func
+            return func
+        return decorator
+
+    async def connect(self):
+        reader, self._writer = await asyncio.open_connection(self.host, self.port, limit=STREAM_LIMIT)
+        await send_message(self._writer, {'op': 'register', 'cluster': self.cluster_id, 'secret': self.secret})
+        asyncio.create_task(self._read(reader))
+
+    async def _read(self, reader: asyncio.StreamReader):
+        while line := await reader.readline():
+            message = json.loads(line)
+            if 'reply_to' in message:
+                future = self._pending.pop(message['reply_to'], None)
+                if future is not None and not future.done():
+                    future.set_result(message['data'])
+            else:
+                asyncio.create_task(self._answer(message))
+        logging.error('Lost IPC connection to the launcher.')
+
+    async def _answer(self, message: dict):
+        handler = self.handlers.get(message['op'])
+        try:
+            data = await handler(message.get('data')) if handler is not None else None
+        except Exception as e:
+            logging.error(f'IPC handler {message["op"]} failed: {e}')
+            data = None
+        await send_message(self._writer, {'reply_to': message['id'], 'data': data})
+
+    async def request(self, op: str, data=None) -> list:
+        """Runs op on every cluster and returns their answers."""
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        await send_message(self._writer, {'id': request_id, 'op': op, 'data': data})
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
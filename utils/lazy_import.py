@@ -0,0 +1,22 @@
+# Defers importing heavy optional modules until they are used.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import importlib
+
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
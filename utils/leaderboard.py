@@ -0,0 +1,114 @@
+# Incrementally maintained economy leaderboards.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import bisect
+import logging
+from collections import OrderedDict
+
+
+class TopN:
+    """The highest `capacity` scores, kept sorted so a page is a slice."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._scores = {}
+        self._ranking = []  # (-score, user_id), ascending
+
+    def __len__(self):
+        return len(self._ranking)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._scores
+
+    def remove(self, user_id: str):
+        score = self._scores.pop(user_id, None)
+        if score is not None:
+            del self._ranking[bisect.bisect_left(self._ranking, (-score, user_id))]
+
+    def update(self, user_id: str, score: int):
+        self.remove(user_id)
+        if len(self._ranking) >= self.capacity and -score >= self._ranking[-1][0]:
+            return
+        bisect.insort(self._ranking, (-score, user_id))
+        self._scores[user_id] = score
+        if len(self._ranking) > self.capacity:
+            _, dropped = self._ranking.pop()
+            del self._scores[dropped]
+
+    def adjust(self, user_id: str, delta: int):
+        # Only users already on the board can be moved, anyone else is picked up by the next reconcile.
+        if user_id in self._scores:
+            self.update(user_id, self._scores[user_id] + delta)
+
+    def page(self, start: int, count: int) -> list[tuple[str, int]]:
+        return [(user_id, -score) for score, user_id in self._ranking[start:start + count]]
+
+
+class Leaderboard:
+    """Global and per-guild rankings by total beans (wallet + bank).
+
+    Every board keeps twice the shown size, so users falling off the top still leave correct entries behind them.
+    The global board is rebuilt from the `total` index every `reconcile_interval` seconds, guild boards are built on
+    first use and dropped on reconcile.
+    """
+
+    def __init__(self, collection, get_guild, size: int = 100, reconcile_interval: float = 600, max_guilds: int = 500):
+        self.collection = collection
+        self.get_guild = get_guild
+        self.size = size
+        self.reconcile_interval = reconcile_interval
+        self.max_guilds = max_guilds
+        self.board = TopN(size * 2)
+        self._guilds = OrderedDict()
+
+    async def _top(self, query: dict) -> TopN:
+        board = TopN(self.size * 2)
+        async for doc in self.collection.find(query, {'userID': 1, 'total': 1}).sort('total', -1).limit(board.capacity):
+            board.update(doc['userID'], doc.get('total', 0))
+        return board
+
+    async def reconcile(self):
+        self.board = await self._top({})
+        self._guilds.clear()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logging.error(f'Failed to reconcile leaderboard: {e}')
+
+    async def guild_board(self, guild) -> TopN:
+        board = self._guilds.get(guild.id)
+        if board is None:
+            members = [str(member.id) for member in guild.members if not member.bot]
+            board = await self._top({'userID': {'$in': members}})
+            self._guilds[guild.id] = board
+            while len(self._guilds) > self.max_guilds:
+                self._guilds.popitem(last=False)
+        self._guilds.move_to_end(guild.id)
+        return board
+
+    def _boards(self, user):
+        yield self.board
+        # Only the cached boards matter; user.mutual_guilds would scan every guild on each payout.
+        for guild_id, board in self._guilds.items():
+            guild = self.get_guild(guild_id)
+            if guild is not None and guild.get_member(user.id) is not None:
+                yield board
+
+    def record(self, user, total: int):
+        for board in self._boards(user):
+            board.update(str(user.id), total)
+
+    def adjust(self, user, delta: int):
+        for board in self._boards(user):
+            board.adjust(str(user.id), delta)
+
+    def remove(self, user_id: str):
+        self.board.remove(user_id)
+        for board in self._guilds.values():
+            board.remove(user_id)
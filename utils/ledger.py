@@ -0,0 +1,122 @@
+# Write-behind buffer for small, frequent currency changes.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import logging
+import time
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+def currency_update(values: dict) -> dict:
+    # total (wallet + bank) is kept alongside so the leaderboard can sort on an index.
+    # $setOnInsert can't touch a field that $inc also changes.
+    defaults = {location: 0 for location in ['wallet', 'bank'] if location not in values}
+    defaults['inventory'] = []
+    return {'$inc': {**values, 'total': sum(values.values())}, '$setOnInsert': defaults}
+
+
+class CurrencyLedger:
+    """Merges currency increments per user in memory and writes them with one bulk_write.
+
+    Pending amounts are flushed every `flush_interval` seconds, as soon as `max_pending` users are waiting, and on
+    shutdown. Readers should add `pending(user_id)` to what they read from the database, which includes a batch that
+    is being written until the write has finished.
+    """
+
+    def __init__(self, collection, flush_interval: float = 2, max_pending: int = 500):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.increments = 0
+        self.writes = 0
+        self.flushes = 0
+        self.last_flush_time = 0.0
+        self._pending = {}
+        self._inflight = {}
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, user_id: str, value: int, location: str):
+        values = self._pending.setdefault(user_id, {})
+        values[location] = values.get(location, 0) + value
+        self.increments += 1
+        if len(self._pending) >= self.max_pending and not self._lock.locked():
+            asyncio.create_task(self.flush())
+
+    def pending(self, user_id: str) -> dict:
+        values = dict(self._inflight.get(user_id, {}))
+        for location, value in self._pending.get(user_id, {}).items():
+            values[location] = values.get(location, 0) + value
+        return values
+
+    def discard(self, user_id: str):
+        self._pending.pop(user_id, None)
+
+    async def flush_user(self, user_id: str):
+        """Write one user's pending amounts now, for operations that need the database to be exact."""
+        # Taking the lock also waits for a running flush, whose batch may include this user.
+        async with self._lock:
+            values = self._pending.pop(user_id, None)
+            if not values:
+                return
+            try:
+                await self.collection.update_one({'userID': user_id}, currency_update(values), upsert=True)
+                self.writes += 1
+            except Exception:
+                self._merge({user_id: values})
+                raise
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            self._inflight = batch
+            users = list(batch)
+            start = time.perf_counter()
+            try:
+                await self.collection.bulk_write(
+                    [UpdateOne({'userID': user_id}, currency_update(batch[user_id]), upsert=True) for user_id in users],
+                    ordered=False)
+            except BulkWriteError as e:
+                # Unordered, so every operation without an error was applied. Only retry the ones that failed.
+                failed = {users[error['index']] for error in e.details['writeErrors']}
+                logging.error(f'Failed to flush {len(failed)}/{len(batch)} pending currency updates: {e}')
+                self._merge({user_id: batch[user_id] for user_id in failed})
+                self.writes += len(batch) - len(failed)
+                return
+            except Exception as e:
+                # We don't know what was applied. Keep the amounts so the next flush retries them; $inc isn't
+                # idempotent, so this can double count, which is preferable to silently losing beans.
+                logging.error(f'Failed to flush {len(batch)} pending currency updates: {e}')
+                self._merge(batch)
+                return
+            finally:
+                self._inflight = {}
+            self.writes += len(batch)
+            self.flushes += 1
+            self.last_flush_time = time.perf_counter() - start
+
+    def _merge(self, batch: dict):
+        for user_id, values in batch.items():
+            for location, value in values.items():
+                pending = self._pending.setdefault(user_id, {})
+                pending[location] = pending.get(location, 0) + value
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Cancelling run() mustn't abandon a batch mid-write, close() waits for it through the lock instead.
+            await asyncio.shield(self.flush())
+
+    async def close(self):
+        await self.flush()
+
+    def stats(self) -> str:
+        saved = self.increments - self.writes - len(self._pending)
+        return (f'{len(self)} users pending, {self.increments} increments in {self.writes} writes '
+                f'({max(saved, 0)} saved), {self.flushes} flushes, last flush {self.last_flush_time * 1000:.1f} ms')
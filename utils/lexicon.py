@@ -0,0 +1,50 @@
+# Local synonym/antonym index, built by utils/build_lexicon.py.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import logging
+import os
+import sqlite3
+
+RELATIONS = {'rel_syn': 0, 'rel_ant': 1}
+
+
+class Lexicon:
+    """Read-only lookups in the SQLite lexicon.
+
+    Each (word, relation) is a single row keyed by its primary key, so a lookup is one B-tree search and fast enough
+    to run directly on the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+
+    @classmethod
+    def open(cls, path: str) -> 'Lexicon | None':
+        if not path or not os.path.exists(path):
+            logging.info(f'No lexicon at {path}, synonym and antonym lookups will use Datamuse.')
+            return None
+        return cls(path)
+
+    def lookup(self, word: str, relation: str) -> list[str] | None:
+        """Related words, or None if the lexicon has none for this word.
+
+        WordNet lists antonyms for few words, so an empty answer is treated as a miss and left to Datamuse.
+        """
+        row = self._db.execute('SELECT related FROM lexicon WHERE word = ? AND relation = ?',
+                               (word, RELATIONS[relation])).fetchone()
+        if row is None or not row[0]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0].split('|')
+
+    def close(self):
+        self._db.close()
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        return f'lexicon: answered {self.hits}/{total} lookups locally'
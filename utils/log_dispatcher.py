@@ -0,0 +1,109 @@
+# Batches automod log embeds per channel.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import logging
+import time
+from collections import deque, Counter
+import discord
+
+MAX_EMBEDS = 10
+MAX_EMBED_CHARS = 6000
+
+
+class LogDispatcher:
+    """Queues log embeds per channel and sends them in batches of up to 10.
+
+    Each channel gets one worker that waits `flush_delay` to collect a burst, then sends at most one message per
+    `send_interval` seconds, which keeps well inside Discord's per-channel limit of 5 messages per 5 seconds.
+    When a channel has `max_queue` embeds waiting, new ones are dropped and a summary of how many were dropped
+    is sent with the next batch.
+    """
+
+    def __init__(self, bot, flush_delay: float = 1, send_interval: float = 1.2, max_queue: int = 100):
+        self.bot = bot
+        self.flush_delay = flush_delay
+        self.send_interval = send_interval
+        self.max_queue = max_queue
+        self.sent = 0
+        self.messages = 0
+        self.dropped = Counter()
+        self.total_dropped = 0
+        self.latencies = deque(maxlen=1000)
+        self._queues = {}
+        self._workers = {}
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def put(self, channel_id: int, embed: discord.Embed):
+        queue = self._queues.setdefault(channel_id, deque())
+        if len(queue) >= self.max_queue:
+            self.dropped[channel_id] += 1
+            self.total_dropped += 1
+            return
+        queue.append((time.monotonic(), embed))
+        if channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.create_task(self._worker(channel_id))
+
+    def _batch(self, channel_id: int) -> list[discord.Embed]:
+        queue = self._queues[channel_id]
+        batch = []
+        size = 0
+        dropped = self.dropped.pop(channel_id, 0)
+        limit = MAX_EMBEDS - 1 if dropped else MAX_EMBEDS
+        while queue and len(batch) < limit and (not batch or size + len(queue[0][1]) <= MAX_EMBED_CHARS):
+            queued_at, embed = queue.popleft()
+            self.latencies.append(time.monotonic() - queued_at)
+            batch.append(embed)
+            size += len(embed)
+        if dropped:
+            batch.append(discord.Embed(title='Log events dropped',
+                                       description=f'{dropped} log events were dropped because too many happened at once.',
+                                       color=discord.Color.orange()))
+        return batch
+
+    async def _send(self, channel_id: int) -> bool:
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            # Channel was deleted or we left the guild, nothing in the queue can be delivered.
+            self._queues.pop(channel_id, None)
+            self.dropped.pop(channel_id, None)
+            return False
+        batch = self._batch(channel_id)
+        try:
+            await channel.send(embeds=batch)
+        except discord.HTTPException as e:
+            logging.warning(f'Could not send {len(batch)} log embeds to {channel_id}: {e}')
+            return True
+        self.sent += len(batch)
+        self.messages += 1
+        return True
+
+    async def _worker(self, channel_id: int):
+        try:
+            await asyncio.sleep(self.flush_delay)
+            while self._queues.get(channel_id) or self.dropped.get(channel_id):
+                if not await self._send(channel_id):
+                    break
+                await asyncio.sleep(self.send_interval)
+        finally:
+            self._workers.pop(channel_id, None)
+            if not self._queues.get(channel_id):
+                self._queues.pop(channel_id, None)
+
+    async def close(self):
+        for worker in list(self._workers.values()):
+            worker.cancel()
+        for channel_id in list(self._queues):
+            while self._queues.get(channel_id):
+                if not await self._send(channel_id):
+                    break
+
+    def stats(self) -> str:
+        latencies = sorted(self.latencies)
+        p50 = latencies[len(latencies) // 2] if latencies else 0
+        p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+        return (f'{self.depth()} queued in {len(self._queues)} channels, {self.sent} embeds sent in {self.messages} '
+                f'messages, {self.total_dropped} dropped, latency p50 {p50:.2f}s p99 {p99:.2f}s')
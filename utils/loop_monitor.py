@@ -0,0 +1,58 @@
+# Detects code blocking the event loop.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+
+class LoopStallDetector:
+    """Watches the event loop from a separate thread.
+
+    A task on the loop records a heartbeat every `interval` seconds. If the heartbeat is older than `threshold`,
+    something is blocking the loop, and the watchdog thread logs the loop thread's current stack so the
+    offending handler shows up in the logs.
+    """
+
+    def __init__(self, threshold: float = 0.5, interval: float = 0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self.longest = 0.0
+        self._beat = time.monotonic()
+        self._loop_thread = None
+        self._thread = None
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='loop-stall-detector', daemon=True)
+        self._thread.start()
+
+    async def _heartbeat(self):
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.interval)
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled > self.threshold:
+                self.longest = max(self.longest, stalled)
+                # Report each stall once, identified by the heartbeat it started after.
+                if reported != beat:
+                    reported = beat
+                    self.stalls += 1
+                    frame = sys._current_frames().get(self._loop_thread)
+                    stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'unavailable'
+                    logging.warning(f'Event loop blocked for over {self.threshold}s, loop thread is at:\n{stack}')
+
+    def stats(self) -> str:
+        return f'{self.stalls} stalls over {self.threshold}s, longest {self.longest:.2f}s'
@@ -0,0 +1,101 @@
+# Renders pilcord memes off the event loop and caches the results.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import aiohttp
+
+TEMPLATES = ['fight_under_this_flag', 'uwu_discord', 'rip']
+MAX_IMAGE_BYTES = 8 * 2 ** 20
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def render(template: str, data: bytes) -> bytes:
+    """Runs in a worker thread. pilcord accepts a PIL image directly, so it never downloads anything itself."""
+    from PIL import Image
+    import pilcord
+    meme = pilcord.Meme(avatar=Image.open(BytesIO(data)))
+    return asyncio.run(getattr(meme, template)()).getvalue()
+
+
+class MemeRenderer:
+    """Downloads source images with the bot's session and renders memes in a small thread pool.
+
+    At most `max_pending` renders are queued or running at once, and finished PNGs are kept in an LRU cache of up to
+    `cache_bytes`, keyed by template and a hash of the source image, so the same avatar is only rendered once.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 16, cache_bytes: int = 64 * 2 ** 20):
+        self.workers = workers
+        self.cache_bytes = cache_bytes
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+        self.render_times = deque(maxlen=100)
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._slots = asyncio.Semaphore(max_pending)
+        # Threads rather than processes: PIL releases the GIL for the expensive image operations, and spawned
+        # workers would re-run main.py, which starts a second bot.
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='memes')
+
+    async def download(self, session: aiohttp.ClientSession, url: str) -> bytes:
+        try:
+            async with session.get(url) as r:
+                if r.status != 200 or (r.content_length or 0) > MAX_IMAGE_BYTES:
+                    raise InvalidImage(url)
+                data = await r.content.read(MAX_IMAGE_BYTES + 1)
+        except aiohttp.ClientError as e:
+            raise InvalidImage(url) from e
+        if len(data) > MAX_IMAGE_BYTES:
+            raise InvalidImage(url)
+        return data
+
+    async def render(self, session: aiohttp.ClientSession, template: str, url: str) -> bytes:
+        if template not in TEMPLATES:
+            raise ValueError(f'Unknown meme template {template}')
+        data = await self.download(session, url)
+        key = (template, hashlib.sha256(data).hexdigest())
+        png = self._cache.get(key)
+        if png is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return png
+        self.misses += 1
+
+        self.pending += 1
+        try:
+            async with self._slots:
+                start = time.perf_counter()
+                try:
+                    png = await asyncio.get_running_loop().run_in_executor(self._executor, render, template, data)
+                except Exception as e:
+                    # Usually a file PIL can't read.
+                    raise InvalidImage(url) from e
+                self.render_times.append(time.perf_counter() - start)
+        finally:
+            self.pending -= 1
+
+        self._cache[key] = png
+        self._cache_size += len(png)
+        while self._cache_size > self.cache_bytes:
+            _, dropped = self._cache.popitem(last=False)
+            self._cache_size -= len(dropped)
+        return png
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        average = sum(self.render_times) / len(self.render_times) if self.render_times else 0
+        return (f'memes: {self.hits}/{total} from cache ({len(self._cache)} images, {self._cache_size / 2 ** 20:.1f} MiB), '
+                f'{self.pending} queued or rendering, render {average * 1000:.0f} ms avg')
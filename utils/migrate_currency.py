@@ -0,0 +1,100 @@
+# This utility converts currency documents from string balances to integers.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+"""
+Bot.addcurrency uses $inc, which fails on documents that still store wallet/bank as strings.
+It also fills in the total field (wallet + bank) that the leaderboard sorts on.
+Older versions of addcurrency could create several documents for one user, those are merged first (balances summed,
+inventories combined) so the unique userID index can be built.
+Run this once with the bot stopped: python3 utils/migrate_currency.py
+It is safe to run again, already converted documents are skipped.
+"""
+
+import os
+import json
+import time
+import argparse
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+
+parser = argparse.ArgumentParser(prog='CurrencyMigrationTool', description='Convert wallet/bank balances to integers.')
+parser.add_argument('-d', '--database_conn_string', help='defaults to dbstring in config.json')
+parser.add_argument('-b', '--batch-size', type=int, default=1000)
+
+args = parser.parse_args()
+
+if args.database_conn_string is None:
+    dir = os.path.realpath(os.path.dirname(__file__))
+    with open(f'{os.path.abspath(os.path.join(dir, os.pardir))}/config.json', 'r') as f:
+        args.database_conn_string = json.load(f)['dbstring']
+
+client = MongoClient(args.database_conn_string)
+currency = client.data.currency
+
+
+
+def to_int(value) -> int:
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def merge(docs: list, session=None):
+    keep, *duplicates = sorted(docs, key=lambda doc: doc['_id'])
+    inventory = []
+    for doc in docs:
+        inventory += [item for item in doc.get('inventory') or [] if item not in inventory]
+    wallet = sum(to_int(doc.get('wallet')) for doc in docs)
+    bank = sum(to_int(doc.get('bank')) for doc in docs)
+    currency.update_one({'_id': keep['_id']}, {'$set': {'wallet': wallet, 'bank': bank, 'total': wallet + bank,
+                                                        'inventory': inventory}}, session=session)
+    currency.delete_many({'_id': {'$in': [doc['_id'] for doc in duplicates]}}, session=session)
+
+
+groups = list(currency.aggregate([{'$group': {'_id': '$userID', 'count': {'$sum': 1}}},
+                                  {'$match': {'count': {'$gt': 1}}}], allowDiskUse=True))
+print(f'{len(groups)} users with duplicate documents')
+transactions = True
+for group in groups:
+    if transactions:
+        try:
+            # Merging is two writes, a transaction keeps an interrupted run from counting balances twice.
+            with client.start_session() as session:
+                session.with_transaction(lambda session: merge(list(currency.find({'userID': group['_id']},
+                                                                                  session=session)), session))
+            continue
+        except OperationFailure as e:
+            if e.code != 20:
+                raise
+            print('	the server does not support transactions, merging without them')
+            transactions = False
+    merge(list(currency.find({'userID': group['_id']})))
+if groups:
+    print(f'Merged duplicates for {len(groups)} users')
+
+query = {'$or': [{'wallet': {'$type': 'string'}}, {'bank': {'$type': 'string'}},
+                 {'wallet': {'$exists': False}}, {'bank': {'$exists': False}}, {'total': {'$exists': False}}]}
+# Converts in place on the server, missing or empty balances become 0.
+pipeline = [{'$set': {
+    'wallet': {'$convert': {'input': '$wallet', 'to': 'long', 'onError': 0, 'onNull': 0}},
+    'bank': {'$convert': {'input': '$bank', 'to': 'long', 'onError': 0, 'onNull': 0}},
+    'inventory': {'$ifNull': ['$inventory', []]}
+}}, {'$set': {'total': {'$add': ['$wallet', '$bank']}}}]
+
+total = currency.count_documents(query)
+print(f'{total} documents to migrate')
+
+done = 0
+start = time.perf_counter()
+while True:
+    ids = [doc['_id'] for doc in currency.find(query, {'_id': 1}).limit(args.batch_size)]
+    if not ids:
+        break
+    currency.update_many({'_id': {'$in': ids}}, pipeline)
+    done += len(ids)
+    elapsed = time.perf_counter() - start
+    print(f'\tmigrated {done}/{total} ({done / elapsed:.0f} docs/s)')
+
+print(f'Finished migrating {done} documents in {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,284 @@
+# Helpers for scoring messages with the Perspective API.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+import aiohttp
+from utils.response_cache import normalize
+from utils.settings_cache import AI_DETECTION_ATTRIBUTES
+
+PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
+
+
+class PerspectiveError(Exception):
+    """The API rejected the request, retrying won't help."""
+
+
+class PerspectiveUnavailable(PerspectiveError):
+    """The API is slow, failing or the pipeline is saturated."""
+
+
+def content_key(text: str) -> str:
+    return hashlib.sha256(normalize(text).encode()).hexdigest()
+
+
+def first_violation(scores: dict, thresholds: dict) -> tuple[str, int] | None:
+    """The first attribute whose score reaches the guild's threshold, as (attribute, threshold)."""
+    for key, score in scores.items():
+        threshold = thresholds.get(key)
+        if threshold is not None and score >= threshold:
+            return key, threshold
+    return None
+
+
+class ScoreCache:
+    """Caches attribute scores by a hash of the normalized message content.
+
+    Every attribute is always requested, so one entry serves every guild no matter which thresholds it uses.
+    Identical messages that arrive while a request is still running wait for that request instead of sending their
+    own. Entries expire after `ttl` seconds and the least recently used one is dropped past `max_size`.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: str, scores: dict):
+        self._entries[key] = (time.monotonic() + self.ttl, scores)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_or_fetch(self, text: str, fetch) -> dict:
+        """Returns cached scores, joins an identical request in flight, or awaits fetch(). Errors are not cached."""
+        key = content_key(text)
+        scores = self.get(key)
+        if scores is not None:
+            self.hits += 1
+            return scores
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            scores = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting on it, don't log "exception was never retrieved".
+            future.exception()
+            raise
+        else:
+            self.set(key, scores)
+            future.set_result(scores)
+            return scores
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> str:
+        total = self.hits + self.coalesced + self.misses
+        saved = self.hits + self.coalesced
+        ratio = self.hits / total * 100 if total else 0
+        return (f'scores: {len(self)} cached, {ratio:.1f}% hit rate, {self.coalesced} coalesced, '
+                f'{saved}/{total} API calls saved')
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and lets one probe through after `reset_after` seconds.
+
+    While open, callers should skip the API entirely. A successful probe closes it again, a failed one reopens it.
+    """
+
+    def __init__(self, threshold: int = 5, reset_after: float = 30):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if self._probing or time.monotonic() - self._opened_at >= self.reset_after:
+            return 'half-open'
+        return 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self._probing or (self._opened_at is None and self.failures >= self.threshold):
+            if not self._probing:
+                self.trips += 1
+                logging.warning(f'Perspective failed {self.failures} times in a row, skipping it for {self.reset_after}s.')
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class PerspectiveClient:
+    """Scores messages through a bounded queue worked by `workers` tasks.
+
+    Each request has a `timeout`, network errors, 429s and 5xx responses are retried up to `retries` times with
+    exponential backoff, and a CircuitBreaker stops calls while the API keeps failing. score() raises
+    PerspectiveUnavailable rather than waiting when the queue is full or the breaker is open, so callers can fail open.
+    """
+
+    def __init__(self, bot, url: str = PERSPECTIVE_URL, workers: int = 10, max_queue: int = 100, timeout: float = 5,
+                 retries: int = 2, backoff: float = 0.5):
+        self.bot = bot
+        self.url = url
+        self.workers = workers
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker()
+        self.in_flight = 0
+        self.requests = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=1000)
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        while not self._queue.empty():
+            future = self._queue.get_nowait()[2]
+            if not future.done():
+                future.set_exception(PerspectiveUnavailable('shutting down'))
+
+    async def score(self, text: str) -> dict:
+        """Scores for every attribute as whole percentages."""
+        if self.breaker.state == 'open':
+            self.rejected += 1
+            raise PerspectiveUnavailable('circuit open')
+        if self._queue.full():
+            self.dropped += 1
+            raise PerspectiveUnavailable('queue full')
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((time.perf_counter(), text, future))
+        return await future
+
+    async def _worker(self):
+        while True:
+            queued_at, text, future = await self._queue.get()
+            try:
+                if future.done():
+                    continue
+                if not self.breaker.allow():
+                    self.rejected += 1
+                    future.set_exception(PerspectiveUnavailable('circuit open'))
+                    continue
+                self.in_flight += 1
+                try:
+                    scores = await self._request_with_retries(text)
+                finally:
+                    self.in_flight -= 1
+            except PerspectiveUnavailable as e:
+                self.breaker.failure()
+                if not future.done():
+                    future.set_exception(e)
+            except PerspectiveError as e:
+                self.errors += 1
+                # The API answered, so it's healthy even though it didn't like this message.
+                self.breaker.success()
+                if not future.done():
+                    future.set_exception(e)
+            except Exception as e:
+                # A bug or a closed session. The worker has to survive it, or every waiting score() hangs.
+                self.errors += 1
+                self.breaker.failure()
+                logging.error(f'Perspective request failed unexpectedly: {e!r}')
+                if not future.done():
+                    future.set_exception(PerspectiveUnavailable(f'{type(e).__name__}: {e}'))
+            else:
+                self.breaker.success()
+                self.latencies.append(time.perf_counter() - queued_at)
+                if not future.done():
+                    future.set_result(scores)
+            finally:
+                self._queue.task_done()
+
+    async def _request_with_retries(self, text: str) -> dict:
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._request(text)
+            except (aiohttp.ClientError, asyncio.TimeoutError, PerspectiveUnavailable) as e:
+                error = e
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.8, 1.2))
+        raise PerspectiveUnavailable(f'{type(error).__name__}: {error}') from error
+
+    async def _request(self, text: str) -> dict:
+        self.requests += 1
+        data = {'comment': {'text': text}, 'languages': ['en'],
+                'requestedAttributes': {attribute: {} for attribute in AI_DETECTION_ATTRIBUTES}}
+        key = self.bot.config.perspective_api_key
+        async with self.bot.session.post(self.url, params={'key': key} if key else None, json=data,
+                                         timeout=self.timeout) as resp:
+            if resp.status == 429 or resp.status >= 500:
+                raise PerspectiveUnavailable(f'HTTP {resp.status}')
+            try:
+                resp_json = await resp.json(content_type=None)
+                if resp.status != 200:
+                    raise PerspectiveError(resp_json['error']['message'])
+                return {key: int(float(value['summaryScore']['value']) * 100)
+                        for key, value in resp_json['attributeScores'].items()}
+            except (ValueError, KeyError, TypeError) as e:
+                raise PerspectiveError(f'Unexpected response (HTTP {resp.status})') from e
+
+    def stats(self) -> str:
+        latencies = sorted(self.latencies)
+        line = (f'perspective: {self._queue.qsize()}/{self._queue.maxsize} queued, {self.in_flight} in flight, '
+                f'{self.requests} requests, circuit {self.breaker.state} ({self.breaker.trips} trips), '
+                f'{self.dropped} dropped, {self.rejected} skipped while open, {self.errors} errors')
+        if latencies:
+            line += ', latency ' + ', '.join(f'p{p} {latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] * 1000:.0f} ms'
+                                             for p in (50, 95, 99))
+        return line
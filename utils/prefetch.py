@@ -0,0 +1,66 @@
+# Keeps a few results from slow APIs ready ahead of time.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+
+class PrefetchPool:
+    """Buffers results of `fetch` so commands don't wait on the API.
+
+    A background task keeps up to `size` results ready, spacing requests by `interval` seconds with some jitter and
+    backing off exponentially while the API fails. When the buffer is empty, get() falls back to a live fetch.
+    Only use this for sources where every call returns something new, each result is served once.
+    """
+
+    def __init__(self, name: str, fetch, size: int = 5, interval: float = 1, max_backoff: float = 300):
+        self.name = name
+        self.fetch = fetch
+        self.size = size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.refill_latencies = deque(maxlen=100)
+        self._buffer = deque()
+        self._wanted = asyncio.Event()
+        self._wanted.set()
+
+    async def get(self):
+        self._wanted.set()
+        if self._buffer:
+            self.hits += 1
+            return self._buffer.popleft()
+        self.misses += 1
+        return await self.fetch()
+
+    async def run(self):
+        backoff = self.interval
+        while True:
+            if len(self._buffer) >= self.size:
+                self._wanted.clear()
+                await self._wanted.wait()
+                continue
+            start = time.perf_counter()
+            try:
+                self._buffer.append(await self.fetch())
+            except Exception as e:
+                self.failures += 1
+                backoff = min(backoff * 2, self.max_backoff)
+                logging.debug(f'Prefetch {self.name} failed, retrying in {backoff:.0f}s: {e}')
+            else:
+                self.refill_latencies.append(time.perf_counter() - start)
+                backoff = self.interval
+            await asyncio.sleep(backoff * random.uniform(0.8, 1.2))
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        latency = sum(self.refill_latencies) / len(self.refill_latencies) if self.refill_latencies else 0
+        return (f'{self.name}: {len(self._buffer)}/{self.size} ready, {ratio:.1f}% hit rate ({self.hits}/{total}), '
+                f'refill {latency * 1000:.0f} ms avg, {self.failures} failures')
@@ -0,0 +1,88 @@
+# Bounded TTL/LRU cache for outbound lookups.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+
+def normalize(query: str) -> str:
+    return ' '.join(query.lower().split())
+
+
+class ResponseCache:
+    """Caches lookup results by normalized query.
+
+    Entries expire after `ttl` seconds and the least recently used one is dropped past `max_size`. With a `path`,
+    the cache is loaded from and saved to a JSON file so it survives restarts, which means values must be JSON
+    serializable.
+    """
+
+    def __init__(self, name: str, max_size: int = 2000, ttl: float = 86400, path: str = None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, query: str):
+        key = normalize(query)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.time():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, query: str, value):
+        key = normalize(query)
+        self._entries[key] = (time.time() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_or_fetch(self, query: str, fetch):
+        """Returns the cached value, or awaits fetch() and caches its result. Exceptions are not cached."""
+        value = self.get(query)
+        if value is None:
+            value = await fetch()
+            self.set(query, value)
+        return value
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Could not load {self.name} cache from {self.path}: {e}')
+            return
+        now = time.time()
+        for key, (expires, value) in entries.items():
+            if expires > now:
+                self._entries[key] = (expires, value)
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(dict(self._entries), f)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        return f'{self.name}: {len(self)} entries, {ratio:.1f}% hit rate ({self.hits}/{total})'
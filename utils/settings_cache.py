@@ -0,0 +1,119 @@
+# In-memory cache for per-guild settings documents.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import time
+from collections import OrderedDict
+from utils.automod_rules import DEFAULT_MIN_LENGTH
+
+AI_DETECTION_ATTRIBUTES = ['TOXICITY', 'SEVERE_TOXICITY', 'IDENTITY_ATTACK', 'INSULT', 'PROFANITY', 'THREAT',
+                           'FLIRTATION', 'OBSCENE', 'SPAM']
+
+
+class AutomodSettings:
+    def __init__(self, doc: dict):
+        self.log_channel = doc.get('log_channel')
+        self.blocked_words = doc.get('blocked_words', [])
+        self.blocked_patterns = doc.get('blocked_patterns', [])
+        self.min_length = doc.get('min_length', DEFAULT_MIN_LENGTH)
+
+
+class AIDetectionSettings:
+    def __init__(self, doc: dict):
+        # A guild with a document but no explicit state counts as enabled, same as before caching.
+        self.enabled = doc.get('enabled') is not False
+        self.thresholds = {key: doc[key] for key in AI_DETECTION_ATTRIBUTES if doc.get(key) is not None}
+
+
+class ActiveGuardSettings:
+    def __init__(self, doc: dict):
+        self.block_known_spammers = doc.get('block_known_spammers') is True
+
+
+class GuildSettingsCache:
+    """Caches one settings collection, keyed by guild id.
+
+    Missing documents are cached as None so guilds without settings don't hit the database on every event.
+    Entries expire after `ttl` seconds and the least recently used entry is dropped once `max_size` is reached.
+    `on_change(collection_name, guild_id)` is called after every write, so other processes can drop their copy.
+    """
+
+    def __init__(self, collection, record: type, max_size: int = 5000, ttl: float = 300, on_change=None):
+        self.collection = collection
+        self.on_change = on_change
+        self.record = record
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _store(self, guild_id: int, doc: dict | None):
+        self._entries[guild_id] = (time.monotonic() + self.ttl, doc)
+        self._entries.move_to_end(guild_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_doc(self, guild_id: int) -> dict | None:
+        entry = self._entries.get(guild_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            self._entries.move_to_end(guild_id)
+            return entry[1]
+        self.misses += 1
+        doc = await self.collection.find_one({'guild': guild_id})
+        self._store(guild_id, doc)
+        return doc
+
+    async def get(self, guild_id: int):
+        doc = await self.get_doc(guild_id)
+        return None if doc is None else self.record(doc)
+
+    async def update(self, guild_id: int, values: dict):
+        """Write-through update. Creates the document if the guild doesn't have one yet."""
+        await self.collection.update_one({'guild': guild_id}, {'$set': values}, upsert=True)
+        entry = self._entries.get(guild_id)
+        if entry is not None and entry[0] > time.monotonic():
+            doc = dict(entry[1]) if entry[1] is not None else {'guild': guild_id}
+            doc.update(values)
+            self._store(guild_id, doc)
+        else:
+            # We don't know the rest of the document, let the next read fetch it.
+            self.invalidate(guild_id)
+        self._changed(guild_id)
+
+    async def modify(self, guild_id: int, update: dict):
+        """Applies an update document like $addToSet or $pull in the database and drops the cached entry."""
+        await self.collection.update_one({'guild': guild_id}, update, upsert=True)
+        self.invalidate(guild_id)
+        self._changed(guild_id)
+
+    def _changed(self, guild_id: int):
+        if self.on_change is not None:
+            self.on_change(self.collection.name, guild_id)
+
+    def invalidate(self, guild_id: int):
+        self._entries.pop(guild_id, None)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        return f'{self.collection.name}: {len(self)} cached, {self.hits} hits, {self.misses} misses ({ratio:.1f}% hit rate)'
+
+
+class SettingsCache:
+    def __init__(self, database, on_change=None):
+        self.automod = GuildSettingsCache(database.automodsettings, AutomodSettings, on_change=on_change)
+        self.ai_detection = GuildSettingsCache(database.ai_detection, AIDetectionSettings, on_change=on_change)
+        self.activeguard = GuildSettingsCache(database.activeguardsettings, ActiveGuardSettings, on_change=on_change)
+
+    def invalidate(self, collection_name: str, guild_id: int):
+        for cache in [self.automod, self.ai_detection, self.activeguard]:
+            if cache.collection.name == collection_name:
+                cache.invalidate(guild_id)
+
+    def stats(self) -> list[str]:
+        return [self.automod.stats(), self.ai_detection.stats(), self.activeguard.stats()]
@@ -0,0 +1,32 @@
+# Records how long each startup step takes.
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import time
+import psutil
+
+
+class StartupTimeline:
+    def __init__(self):
+        self.process = psutil.Process()
+        self.start = time.perf_counter()
+        self.start_rss = self.process.memory_info().rss
+        self.events = []  # (name, duration, rss delta, time since start)
+
+    def mark(self, name: str):
+        self.events.append((name, 0.0, self.process.memory_info().rss - self.start_rss, time.perf_counter() - self.start))
+
+    async def measure(self, name: str, coro):
+        start = time.perf_counter()
+        rss = self.process.memory_info().rss
+        result = await coro
+        self.events.append((name, time.perf_counter() - start, self.process.memory_info().rss - rss,
+                            time.perf_counter() - self.start))
+        return result
+
+    def report(self) -> str:
+        lines = ['Startup timeline:']
+        for name, duration, rss_delta, at in self.events:
+            lines.append(f'  {at:7.2f}s  {name:<24} {duration * 1000:8.1f} ms  {rss_delta / 2 ** 20:+7.1f} MiB')
+        lines.append(f'  total RSS {self.process.memory_info().rss / 2 ** 20:.1f} MiB')
+        return '\n'.join(lines)